@@ -1,14 +1,19 @@
-import asyncio
-import nest_asyncio
-nest_asyncio.apply()
+import time
+STARTED_AT = time.monotonic()  # от этой точки считаем время до готовности и первого ответа
 
+import asyncio
+import hashlib
+import hmac
 import logging
 import random
-import feedparser
-import aiosqlite
-from html import unescape 
+import httpx
+from html import escape, unescape
 import re
-from datetime import datetime, timedelta, time
+import secrets
+import signal
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 
 from telegram import (
     Update, 
@@ -16,19 +21,32 @@ from telegram import (
     InlineKeyboardButton, 
     ChatPermissions, 
     InputTextMessageContent,
+    InlineQueryResultArticle,
     InputMediaPhoto,
     ChatMember
 )
+from telegram.constants import ChatType
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     ApplicationBuilder, 
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler, 
     CallbackQueryHandler,
+    ChatMemberHandler,
+    InlineQueryHandler,
     MessageHandler, 
+    TypeHandler,
     filters, 
     ContextTypes,
     JobQueue
 )
+from telegram.request import HTTPXRequest
 
+import db
+import config
+import metrics
+from telegram_html import TELEGRAM_TEXT_LIMIT, to_telegram_html, truncate_text, visible_length
 from config import PODCAST_BOT, ADMINS, PODCAST_chat_id, PODCAST_channel_id
 
 # ——————————————————————————————————————————————————————————
@@ -52,158 +70,627 @@ PLATFORM_LINKS = [
     ("🌐 Все платформы", "https://chetamnovosti.ru/#rec612439744")
 ]
 
+# Режим работы: "polling" (по умолчанию) или "webhook" — см. config.py.example
+BOT_MODE = getattr(config, "BOT_MODE", "polling")
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", "")            # публичный https-адрес за прокси
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", "")      # X-Telegram-Bot-Api-Secret-Token; пусто — сгенерируем
+WEBHOOK_LISTEN = getattr(config, "WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8080)
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/telegram")
+WEBHOOK_MAX_CONNECTIONS = getattr(config, "WEBHOOK_MAX_CONNECTIONS", 40)
+CONCURRENT_UPDATES = getattr(config, "CONCURRENT_UPDATES", 16)   # параллельных обработчиков
+# Отдельный сервер /metrics для режима polling (в режиме webhook /metrics
+# отдаёт сам webhook-сервер); None — не поднимать
+METRICS_LISTEN = getattr(config, "METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", None)
+# Адрес Bot API; для тестов можно указать локальную заглушку Telegram
+TELEGRAM_API_URL = getattr(config, "TELEGRAM_API_URL", "https://api.telegram.org/bot")
+# Исходящие запросы к Bot API (см. OutboundRateLimiter)
+TELEGRAM_POOL_SIZE = getattr(config, "TELEGRAM_POOL_SIZE", 64)          # соединений с Bot API
+TELEGRAM_KEEPALIVE = getattr(config, "TELEGRAM_KEEPALIVE", 30.0)        # секунд держим простаивающее соединение
+TELEGRAM_HTTP_VERSION = getattr(config, "TELEGRAM_HTTP_VERSION", "1.1")  # "2" — нужен пакет h2
+OUTBOUND_GLOBAL_RATE = getattr(config, "OUTBOUND_GLOBAL_RATE", 28)      # запросов в чаты в секунду на бота
+OUTBOUND_MAX_RETRIES = getattr(config, "OUTBOUND_MAX_RETRIES", 3)
+OUTBOUND_BACKOFF = 1.0   # первая пауза при сетевой ошибке, дальше — вдвое больше
+OUTBOUND_JITTER = 1.0    # случайная добавка к паузе, чтобы повторы не шли разом
+
 # Время кэширования RSS (например, 1 день = 86400 секунд)
 CACHE_EXPIRY = 86400  # 1 день
-last_update_time = None
-cached_feed = []
 
-# Утилита для очистки HTML‑тегов
+# Утилита для очистки HTML‑тегов: чистый текст для поиска.
+# В сообщения описание идёт через telegram_html.to_telegram_html
 def clean_html(raw_html: str) -> str:
     # Убираем все теги <...>
     text = re.sub(r'<[^>]+>', '', raw_html or "")
     # Раскодируем HTML‑сущности, если есть
     return unescape(text).strip()
 
-# Общая кнопка "Назад"
+# Общая кнопка "Назад". Клавиатуры в PTB неизменяемые, поэтому статические
+# собираются один раз при импорте и переиспользуются во всех ответах
+BACK_BUTTON = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back")]])
+
+
 def get_back_button():
-    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back")]])
+    return BACK_BUTTON
 
 # ——————————————————————————————————————————————————————————
-# SQL модели: users, actions, subscriptions, settings, moderation_logs
+# ---------- РЕЕСТР ЛЕНТ ----------
+# Один процесс обслуживает несколько подкастов. Реестр живёт в таблице feeds:
+# у каждой ленты свой канал, ссылки на платформы, каталог, подписчики и
+# автопостинг. Лента из настроек выше — лента по умолчанию, с ней работает
+# меню бота; остальные добавляются через FEEDS в config.py.
+DEFAULT_FEED_SLUG = getattr(config, "DEFAULT_FEED_SLUG", "chetamnovosti")
+FEEDS_CONFIG = [
+    {
+        "slug": DEFAULT_FEED_SLUG,
+        "title": "Чё там новости?",
+        "rss_url": RSS_FEED,
+        "site_link": PODCAST_LINK,
+        "channel_id": PODCAST_channel_id,
+        "platform_links": PLATFORM_LINKS,
+    },
+    *getattr(config, "FEEDS", []),
+]
+
+
+class Feed:
+    # Состояние ленты в памяти: каталог эпизодов, валидаторы HTTP-кэша, готовые тексты
+    def __init__(self, feed_id, slug, title, rss_url, site_link, channel_id, platform_links,
+                 etag=None, last_modified=None):
+        self.id = feed_id
+        self.etag = etag
+        self.last_modified = last_modified
+        self.lock = asyncio.Lock()      # одновременно ленту качает только один запрос
+        self.episodes = []              # хэндлеры читают эпизоды только отсюда
+        self.by_guid = {}
+        self.digest = None
+        self.last_update_time = None
+        self.rendered = {}              # guid -> RenderedEpisode
+        self.latest_text = ""           # блок «Три последних эпизода»
+        self.archive_pages = []         # [(текст, клавиатура)] архива, см. build_archive_pages
+        # Планировщик опроса (см. run_feed_scheduler)
+        self.freshness = None           # секунд свежести по Cache-Control/Expires
+        self.next_poll_at = 0.0         # время event loop
+        self.idle_interval = POLL_MIN_IDLE
+        self.check_pending = True       # при старте проверяем новые выпуски даже без изменений
+        self.seen_guids = None          # guid опубликованных/пропущенных выпусков (из seen_episodes)
+        self.configure(slug, title, rss_url, site_link, channel_id, platform_links)
+
+    def configure(self, slug, title, rss_url, site_link, channel_id, platform_links):
+        self.slug = slug
+        self.title = title or slug
+        self.rss_url = rss_url
+        self.site_link = site_link
+        self.channel_id = channel_id
+        self.platforms_keyboard = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(name, url=url)] for name, url in platform_links]
+            + [[InlineKeyboardButton("⬅️ Назад", callback_data="back")]]
+        )
+
+
+FEEDS = {}  # slug -> Feed
+
+
+async def load_feed_registry():
+    # Сверяет ленты в памяти с таблицей feeds: новые добавляет, выключенные убирает
+    rows = await db.load_feeds()
+    if rows is None:
+        return
+    active = set()
+    for feed_id, slug, title, rss_url, site_link, channel_id, platform_links, etag, last_modified in rows:
+        key = feed_key(slug)
+        active.add(key)
+        if key in FEEDS:
+            FEEDS[key].configure(slug, title, rss_url, site_link, channel_id, platform_links)
+        else:
+            FEEDS[key] = Feed(feed_id, slug, title, rss_url, site_link, channel_id, platform_links, etag, last_modified)
+            logging.info(f"Лента {slug} (#{feed_id}) подключена: {rss_url}")
+    for key in set(FEEDS) - active - {feed_key(DEFAULT_FEED_SLUG)}:
+        del FEEDS[key]
+        logging.info(f"Лента {key} отключена.")
+
+
+def feed_key(slug):
+    # Ключ ленты в FEEDS: slug из команд, кнопок и настроек без учёта регистра
+    return slug.strip().lower()
+
+
+def get_feed(slug=None):
+    # Лента по slug; без slug — лента по умолчанию
+    if slug:
+        return FEEDS.get(feed_key(slug))
+    feed = FEEDS.get(feed_key(DEFAULT_FEED_SLUG)) or next(iter(FEEDS.values()), None)
+    if feed is None:
+        # prepare_storage не даёт стартовать без лент, сюда попадать не должны
+        raise RuntimeError("Не подключено ни одной ленты")
+    return feed
+
+
+# ——————————————————————————————————————————————————————————
+# ---------- RSS ФУНКЦИИ ----------
+# Все хэндлеры читают эпизоды только из памяти (Feed.episodes).
+# Сеть трогает лишь update_episode_cache: скачивание идёт через асинхронный
+# httpx, а разбор feedparser'ом — в пуле потоков, чтобы не блокировать event loop.
+RSS_TIMEOUT = 20  # секунд на скачивание RSS
+# Сколько лент качаем одновременно (и сколько соединений держит httpx)
+FEED_POLL_CONCURRENCY = getattr(config, "FEED_POLL_CONCURRENCY", 8)
+
+_http_client = None
+_poll_slots = asyncio.Semaphore(FEED_POLL_CONCURRENCY)
+
+
+def get_http_client():
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=RSS_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=FEED_POLL_CONCURRENCY)
+        )
+    return _http_client
+
+
+# Эпизод ленты. guid — стабильный ключ для сравнения версий ленты
+Episode = namedtuple("Episode", "title url description guid published")
+
 
-async def get_db_connection():
-    return await aiosqlite.connect("bot.db")
+def parse_feed(content: bytes):
+    # Синхронный разбор RSS — вызывается только из executor.
+    # feedparser тяжёлый, импортируем при первом разборе, а не при старте бота
+    import feedparser
+    feed = feedparser.parse(content)
+
+    # Проверяем на ошибку парсинга
+    if feed.bozo:
+        logging.error(f"Ошибка парсинга RSS: {feed.bozo_exception}")
+        return None
+
+    episodes = []
+
+    # Проходим по всем записям в RSS
+    for entry in feed.entries:
+        title = entry.get("title", "")
+        url = entry.get("link", "")
+        description = entry.get("description", "")  # Если описание отсутствует, будет пустая строка
+        guid = entry.get("id") or url or title
+        published = entry.get("published_parsed")
+
+        episodes.append(Episode(
+            title, url, description, guid,
+            datetime(*published[:6]) if published else None
+        ))
+
+    return episodes
+
+
+def chronological(episodes):
+    # Внутри бота эпизоды всегда идут от старых к новым: последний — самый свежий.
+    # Лента может быть в любом порядке (обычно свежие первыми); выпуски без даты
+    # считаем самыми старыми и оставляем в обратном порядке ленты
+    return sorted(reversed(episodes), key=lambda ep: ep.published or datetime.min)
+
+
+def diff_episodes(old_by_guid, episodes):
+    # Сравнивает свежую ленту с прошлой по guid.
+    # Возвращает (список для кэша, новые/изменённые эпизоды); неизменённые
+    # эпизоды берутся из прошлой версии, чтобы их не обрабатывать повторно.
+    merged, changed = [], []
+    for ep in episodes:
+        old = old_by_guid.get(ep.guid)
+        if old == ep:
+            merged.append(old)
+        else:
+            merged.append(ep)
+            changed.append(ep)
+    return merged, changed
+
+
+async def fetch_episodes_from_rss(feed, etag=None, last_modified=None):
+    # Условный GET ленты. Возвращает (response, episodes):
+    #   episodes=None — лента не изменилась (304 или то же содержимое);
+    #   (None, None) — RSS получить не удалось.
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
 
-async def get_user_count():
     try:
-        db = await get_db_connection()
-        cursor = await db.execute("SELECT COUNT(*) FROM users")
-        result = await cursor.fetchone()
-        await db.close()
-        return result[0]
+        with metrics.RSS_FETCH_SECONDS.time(feed=feed.slug):
+            response = await get_http_client().get(feed.rss_url, headers=headers)
+        if response.status_code == 304:
+            metrics.RSS_FETCHES.inc(feed=feed.slug, status="304")
+            return response, None
+        response.raise_for_status()
+
+        # Сервер может игнорировать валидаторы — тогда сверяем само содержимое
+        digest = hashlib.sha1(response.content).hexdigest()
+        if digest == feed.digest:
+            metrics.RSS_FETCHES.inc(feed=feed.slug, status="unchanged")
+            return response, None
+
+        loop = asyncio.get_running_loop()
+        with metrics.RSS_PARSE_SECONDS.time(feed=feed.slug):
+            episodes = await loop.run_in_executor(None, parse_feed, response.content)
+        if episodes is None:
+            metrics.RSS_FETCHES.inc(feed=feed.slug, status="parse_error")
+            return None, None
+
+        metrics.RSS_FETCHES.inc(feed=feed.slug, status="200")
+        feed.digest = digest
+        return response, episodes
     except Exception as e:
-        logging.error(f"Ошибка при получении количества пользователей: {e}")
+        metrics.RSS_FETCHES.inc(feed=feed.slug, status="error")
+        logging.error(f"Ошибка при получении данных из RSS ленты {feed.slug}: {e}")
+        return None, None
+
+
+def cache_freshness(headers):
+    # Сколько секунд ответ свежий по Cache-Control / Expires; None — сервер не сказал
+    cache_control = headers.get("Cache-Control", "").lower()
+    if "no-cache" in cache_control or "no-store" in cache_control:
         return 0
-    
-async def init_db():
+    match = re.search(r"\bmax-age=(\d+)", cache_control)
+    if match:
+        return int(match.group(1))
+    expires = headers.get("Expires")
+    if not expires:
+        return None
     try:
-        async with aiosqlite.connect("bot.db") as db:
-            # Создаем таблицу пользователей
-            try:
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        user_id INTEGER PRIMARY KEY,
-                        username TEXT,
-                        first_name TEXT,
-                        last_seen TEXT
-                    )
-                """)
-            except Exception as e:
-                logging.error(f"Ошибка при создании таблицы users: {e}")
-            
-            # Создаем таблицу действий
-            try:
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS actions (
-                        id       INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id  INTEGER,
-                        action   TEXT,
-                        time     TEXT
-                    )
-                """)
-            except Exception as e:
-                logging.error(f"Ошибка при создании таблицы actions: {e}")
+        expires_at = parsedate_to_datetime(expires)
+        date = parsedate_to_datetime(headers["Date"]) if headers.get("Date") else datetime.now(timezone.utc)
+        return max(0, (expires_at - date).total_seconds())
+    except (TypeError, ValueError):
+        return 0  # «Expires: 0» и прочие невалидные даты означают «уже устарел»
+
+
+async def load_persisted_episodes(feed):
+    # Каталог ленты из базы — вызывается под feed.lock
+    feed.episodes = chronological([
+        Episode(title, url, description, guid, datetime.fromisoformat(published) if published else None)
+        for title, url, description, guid, published in await db.load_episodes(feed.id)
+    ])
+    feed.by_guid = {ep.guid: ep for ep in feed.episodes}
+    await refresh_render_cache(feed)
 
-            # Создаем таблицу настроек
-            try:
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS settings (
-                        key   TEXT PRIMARY KEY,
-                        value TEXT
-                    )
-                """)
-            except Exception as e:
-                logging.error(f"Ошибка при создании таблицы settings: {e}")
 
-            # Создаем таблицу логов модерации
-            try:
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS moderation_logs (
-                        id          INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id     INTEGER,
-                        username    TEXT,
-                        reason      TEXT,
-                        timestamp   TEXT
-                    )
-                """)
-            except Exception as e:
-                logging.error(f"Ошибка при создании таблицы moderation_logs: {e}")
+# Фоновые задачи вне хэндлеров. Event loop держит задачи лишь слабой ссылкой,
+# поэтому храним их здесь до завершения, а при остановке бота отменяем
+_background_tasks = set()
 
-            # Коммитим изменения в базе данных
-            try:
-                await db.commit()
-            except Exception as e:
-                logging.error(f"Ошибка при коммите изменений в базе данных: {e}")
-    except Exception as e:
-        logging.error(f"Ошибка при подключении к базе данных: {e}")
 
-        
-# ——————————————————————————————————————————————————————————
-# ---------- RSS ФУНКЦИИ ----------
-async def update_episode_cache(context):
-    global last_update_time, cached_feed
+def run_in_background(coro, name):
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+def _background_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Ошибка фоновой задачи {task.get_name()}: {task.exception()}")
 
-    try:
-        feed = feedparser.parse(RSS_FEED)
 
-        # Проверка на ошибки парсинга
-        if feed.bozo:
-            logging.error(f"Ошибка парсинга RSS: {feed.bozo_exception}")
+async def cancel_background_tasks():
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+
+async def warm_up_feed(feed):
+    # Прогрев после рестарта: сначала копия из базы, без похода в сеть.
+    # Свежий RSS подтянет первый тик планировщика
+    async with feed.lock:
+        if feed.episodes or feed.last_update_time is not None:
             return
+        await load_persisted_episodes(feed)
+        if feed.episodes:
+            feed.last_update_time = datetime.utcnow()
+            logging.info(
+                f"Лента {feed.slug}: из базы загружено эпизодов: {len(feed.episodes)}, "
+                f"последний: {feed.episodes[-1].title}"
+            )
+        else:
+            logging.info(f"Лента {feed.slug}: каталог в базе пуст, ждём RSS.")
 
-        # Обрабатываем только те записи, которые содержат title и link
-        valid_entries = [(e.title, e.link) for e in feed.entries if hasattr(e, 'title') and hasattr(e, 'link')]
-        
-        # Кэшируем полученные данные
-        cached_feed = valid_entries
-        last_update_time = time.time()  # Обновляем время последнего кэширования
 
-        logging.info("Кэш обновлен. Эпизоды загружены.")
+async def warm_up_feeds():
+    feeds = list(FEEDS.values())
+    results = await asyncio.gather(*(warm_up_feed(feed) for feed in feeds), return_exceptions=True)
+    for feed, result in zip(feeds, results):
+        if isinstance(result, Exception):
+            logging.error(f"Ошибка при прогреве ленты {feed.slug}: {result}")
+    log_startup_stage("cache_warm", "Прогрев кэша эпизодов завершён")
 
-    except Exception as e:
-        logging.error(f"Ошибка при получении данных из RSS: {e}")
 
-async def fetch_episodes_from_rss():
-    try:
-        feed = feedparser.parse(RSS_FEED)
-        
-        # Проверяем на ошибку парсинга
-        if feed.bozo:
-            logging.error(f"Ошибка парсинга RSS: {feed.bozo_exception}")
+async def update_episode_cache(context=None, feed=None):
+    # Обновляет ленту в памяти и возвращает новые/изменённые эпизоды
+    feed = feed or get_feed()
+
+    # Одновременно RSS качает только один запрос, остальные ждут его результата
+    async with feed.lock:
+        # После рестарта сначала поднимаем каталог из базы
+        if not feed.episodes:
+            await load_persisted_episodes(feed)
+
+        # Валидаторы шлём, только если нам есть что переиспользовать
+        if feed.episodes:
+            etag, last_modified = feed.etag, feed.last_modified
+        else:
+            etag = last_modified = None
+
+        response, episodes = await fetch_episodes_from_rss(feed, etag, last_modified)
+        feed.freshness = cache_freshness(response.headers) if response is not None else None
+        if response is None:
+            # Оставляем в памяти прошлую версию ленты (или каталог из базы)
+            if feed.episodes and feed.last_update_time is None:
+                feed.last_update_time = datetime.utcnow() - timedelta(seconds=CACHE_EXPIRY)
+            return []
+
+        feed.last_update_time = datetime.utcnow()  # Лента подтверждена свежей
+        if episodes is None:
+            logging.info(f"RSS ленты {feed.slug} не изменился, разбор пропущен.")
             return []
-        
-        episodes = []
-        
-        # Проходим по всем записям в RSS
-        for entry in feed.entries:
-            title = entry.get("title", "")
-            url = entry.get("link", "")
-            description = entry.get("description", "")  # Если описание отсутствует, будет пустая строка
 
-            # Добавляем в список в формате (title, url, description)
-            episodes.append((title, url, description))
+        merged, changed = diff_episodes(feed.by_guid, episodes)
+
+        # Кэшируем полученные данные
+        feed.episodes = chronological(merged)
+        feed.by_guid = {ep.guid: ep for ep in merged}
+        await refresh_render_cache(feed)
+
+        await db.save_episodes(feed.id, [(ep, get_rendered(ep, feed).description) for ep in changed])
+        feed.etag = response.headers.get("ETag", "")
+        feed.last_modified = response.headers.get("Last-Modified", "")
+        await db.set_feed_validators(feed.id, feed.etag, feed.last_modified)
+
+        logging.info(f"Кэш ленты {feed.slug} обновлен. Эпизодов: {len(merged)}, новых или изменённых: {len(changed)}.")
+        return changed
+
+
+async def poll_feed(feed):
+    # Одновременно опрашивается не больше FEED_POLL_CONCURRENCY лент
+    async with _poll_slots:
+        return await update_episode_cache(feed=feed)
+
+
+async def get_episodes(feed=None):
+    # Эпизоды из памяти; сеть — только если кэш ещё ни разу не заполнялся
+    feed = feed or get_feed()
+    if feed.last_update_time is None:
+        metrics.CACHE_REQUESTS.inc(cache="episodes", result="miss")
+        if feed.lock.locked():
+            # Ленту уже кто-то качает — дожидаемся его результата
+            async with feed.lock:
+                pass
+        else:
+            await update_episode_cache(feed=feed)
+        return feed.episodes
+
+    metrics.CACHE_REQUESTS.inc(cache="episodes", result="hit")
+    if datetime.utcnow() - feed.last_update_time > timedelta(seconds=CACHE_EXPIRY) and not feed.lock.locked():
+        # Кэш протух (например, джоба падала) — отдаём что есть и обновляем в фоне
+        run_in_background(update_episode_cache(feed=feed), name=f"refresh:{feed.slug}")
+    return feed.episodes
+
+
+# ---------- ГОТОВЫЕ ТЕКСТЫ ЭПИЗОДОВ ----------
+# Тексты эпизодов собираются один раз на версию ленты: update_episode_cache
+# пересобирает кэш только для новых и изменённых эпизодов (в пуле потоков —
+# разбор HTML описаний не должен тормозить event loop), а хэндлеры
+# берут готовые строки без regex и форматирования.
+RANDOM_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔁 Другой случайный эпизод", callback_data="random")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
+])
+
+RenderedEpisode = namedtuple("RenderedEpisode", "episode description random_text post_text share_text")
+
+
+def render_episode(ep):
+    # Заголовок и ссылку экранируем, описание переводим в Telegram-HTML.
+    # description в кэше — чистый текст для полнотекстового индекса
+    title, url = escape(ep.title), escape(ep.url, quote=True)
+    random_text = f"🎲 <b>Случайный эпизод:\n\n🔹 <a href=\"{url}\">{title}</a></b>"
+    post_text = (
+        f"🎙 <b>Новый выпуск:</b>\n\n"
+        f"🔹 <a href=\"{url}\">{title}</a>\n"
+    )
+    # Сообщение, которое пользователь отправляет из inline-режима
+    share_text = f"🎙 <b><a href=\"{url}\">{title}</a></b>"
+    # Описание обрезаем так, чтобы все сообщения уложились в лимит Telegram
+    budget = TELEGRAM_TEXT_LIMIT - max(visible_length(random_text), visible_length(post_text)) - 2
+    desc = to_telegram_html(ep.description, budget)
+    if desc:
+        random_text += f"\n\n<i>{desc}</i>"
+        post_text += f"\n<i>{desc}</i>"
+        share_text += f"\n\n<i>{desc}</i>"
+    return RenderedEpisode(ep, clean_html(ep.description), random_text, post_text, share_text)
 
-        return episodes
-    except Exception as e:
-        logging.error(f"Ошибка при получении данных из RSS: {e}")
-        return []
+
+def render_episodes(episodes):
+    return [render_episode(ep) for ep in episodes]
+
+
+async def refresh_render_cache(feed):
+    # Неизменённые эпизоды переносим из прошлой версии кэша, новые рендерим в executor
+    episodes, rendered = feed.episodes, feed.rendered
+    fresh = [ep for ep in episodes if not (ep.guid in rendered and rendered[ep.guid].episode == ep)]
+    if fresh:
+        loop = asyncio.get_running_loop()
+        for item in await loop.run_in_executor(None, render_episodes, fresh):
+            rendered[item.episode.guid] = item
+    feed.rendered = {ep.guid: rendered[ep.guid] for ep in episodes}
+
+    text = "🎙 <b>Три последних эпизода:</b>\n"
+    for ep in episodes[-3:][::-1]:  # Описание здесь не используем
+        text += f"🔹 <b><a href=\"{escape(ep.url, quote=True)}\">{escape(ep.title)}</a></b>\n"
+    feed.latest_text = text
+    feed.archive_pages = build_archive_pages(episodes)
+
+
+def get_rendered(ep, feed=None):
+    feed = feed or get_feed()
+    cached = feed.rendered.get(ep.guid)
+    if cached and cached.episode == ep:
+        metrics.CACHE_REQUESTS.inc(cache="render", result="hit")
+        return cached
+    metrics.CACHE_REQUESTS.inc(cache="render", result="miss")
+    cached = feed.rendered[ep.guid] = render_episode(ep)
+    return cached
+
+
+# ——————————————————————————————————————————————————————————
+# Метрики горячих путей (см. metrics.py, отдаются на /metrics)
+def timed(name, callback):
+    # Оборачивает хэндлер: время его работы попадает в bot_handler_seconds
+    async def wrapper(update, context):
+        with metrics.HANDLER_SECONDS.time(handler=name):
+            return await callback(update, context)
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    # Считает запросы к Bot API по методу и коду ответа
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        status = "network_error"
+        try:
+            with metrics.TELEGRAM_API_SECONDS.time(method=api_method):
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            metrics.TELEGRAM_API_REQUESTS.inc(method=api_method, status=status)
+
+
+# ---------- ИСХОДЯЩИЕ ЗАПРОСЫ К BOT API ----------
+# Все запросы бота (хэндлеры, предупреждения модерации, рассылка) проходят
+# через один OutboundRateLimiter: общий бюджет на бота и свой на каждый чат,
+# так что всплеск сглаживается очередью, а не упирается в 429. Ошибки делятся
+# на временные (RetryAfter, сеть, таймауты) — повторяем с джиттером — и
+# окончательные (Forbidden, BadRequest и прочее) — сразу наверх.
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в личку,
+# 20 в минуту в группу.
+CHAT_RATES = {            # (сообщений в секунду, всплеск)
+    "private": (1.0, 3),
+    "group": (20 / 60, 5),
+}
+OUTBOUND_CHAT_BUCKETS_LIMIT = 1024   # дальше — выбрасываем простаивающие ведра
+# Лимиты — на то, что появляется в чате; удаление, ответы на нажатия и inline не ждут
+LIMITED_ENDPOINTS = ("send", "edit", "copy", "forward")
+# Правка своего же сообщения (меню, листание архива) новых сообщений в чат не
+# добавляет: она идёт только через общий бюджет, иначе быстрое листание упиралось
+# бы в 1 сообщение в секунду под замком очереди чата
+CHAT_EXEMPT_ENDPOINTS = ("edit",)
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, max_retries=OUTBOUND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.max_retries = max_retries
+        self._global = None
+        self._chats = {}   # chat_id -> TokenBucket
+
+    async def initialize(self):
+        # TokenBucket привязан к event loop — создаём при старте бота
+        self._global = TokenBucket(self.global_rate)
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > OUTBOUND_CHAT_BUCKETS_LIMIT:
+                for key in [key for key, old in self._chats.items() if old.idle()]:
+                    del self._chats[key]
+            # Отрицательные id и @username — группы и каналы
+            kind = "private" if isinstance(chat_id, int) and chat_id > 0 else "group"
+            bucket = self._chats[chat_id] = TokenBucket(*CHAT_RATES[kind])
+        return bucket
+
+    def has_capacity(self, chat_id):
+        # Можно ли отправить в чат без ожидания — для сообщений, которые не жалко пропустить
+        return self._chat_bucket(chat_id).available() and (self._global is None or self._global.available())
+
+    async def _acquire(self, endpoint, chat_id):
+        if chat_id is None or not endpoint.startswith(LIMITED_ENDPOINTS):
+            return
+        started = asyncio.get_running_loop().time()
+        if not endpoint.startswith(CHAT_EXEMPT_ENDPOINTS):
+            await self._chat_bucket(chat_id).acquire()
+        await self._global.acquire()
+        metrics.OUTBOUND_WAIT_SECONDS.observe(asyncio.get_running_loop().time() - started, method=endpoint)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+
+        attempt = 0
+        while True:
+            await self._acquire(endpoint, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    raise
+                # Флуд-контроль Telegram: останавливаем все отправки, не только эту,
+                # и сами ждём паузу — у удаления и ответов на нажатия ведра нет
+                wait = retry_after_seconds(e) + random.uniform(0, OUTBOUND_JITTER)
+                self._global.pause(wait)
+                reason = "retry_after"
+                logging.warning(f"Bot API: флуд-контроль на {endpoint}, пауза {wait:.1f} с")
+                await asyncio.sleep(wait)
+            except (Forbidden, BadRequest):
+                # Подклассы NetworkError, но повтор тут не поможет
+                raise
+            except (TimedOut, NetworkError) as e:
+                if attempt >= max_retries:
+                    raise
+                wait = OUTBOUND_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                reason = "network"
+                logging.warning(f"Bot API: {endpoint} не прошёл ({e}), повтор через {wait:.1f} с")
+                await asyncio.sleep(wait)
+            attempt += 1
+            metrics.OUTBOUND_RETRIES.inc(method=endpoint, reason=reason)
+
+
+def telegram_http_version():
+    # HTTP/2 включаем, только если установлен h2 (pip install "httpx[http2]")
+    if str(TELEGRAM_HTTP_VERSION).startswith("2"):
+        try:
+            import h2  # noqa: F401
+            return "2"
+        except ImportError:
+            logging.warning("TELEGRAM_HTTP_VERSION = 2, но пакет h2 не установлен — работаем по HTTP/1.1.")
+    return "1.1"
+
+
+def build_request():
+    # Пул соединений к Bot API: keep-alive держит соединения прогретыми между всплесками
+    return InstrumentedRequest(
+        connection_pool_size=TELEGRAM_POOL_SIZE,
+        http_version=telegram_http_version(),
+        httpx_kwargs={"limits": httpx.Limits(
+            max_connections=TELEGRAM_POOL_SIZE,
+            max_keepalive_connections=TELEGRAM_POOL_SIZE,
+            keepalive_expiry=TELEGRAM_KEEPALIVE,
+        )},
+    )
 
 
 # ——————————————————————————————————————————————————————————
 # Функция отправки сообщений с логированием и обработкой ошибок
 async def send_html_with_logging(bot, chat_id, text, reply_markup=None, disable_web_page_preview=False):
+    # Возвращает отправленное сообщение или None, если отправить не удалось
     try:
-        await bot.send_message(
+        return await bot.send_message(
             chat_id=chat_id,
             text=text,
             parse_mode="HTML",
@@ -211,95 +698,146 @@ async def send_html_with_logging(bot, chat_id, text, reply_markup=None, disable_
             disable_web_page_preview=disable_web_page_preview  
         )
     except Exception as e:
+        # Повторы уже сделал OutboundRateLimiter; второе сообщение об ошибке
+        # в тот же чат упрётся в ту же проблему
         logging.error(f"Ошибка при отправке сообщения в чат {chat_id}: {e}")
-        await bot.send_message(chat_id, "❌ Произошла ошибка при отправке информации. Попробуйте позже.")
+        return None
+
+
+# ---------- НАВИГАЦИЯ ----------
+# Экран меню показывается в том сообщении, из которого нажали кнопку:
+# edit_message_text вместо нового sendMessage. Хэш показанного экрана лежит
+# в chat_data по message_id, и если экран не изменился, Telegram не вызываем
+# вовсе. Новое сообщение отправляется, только если редактировать нечего
+# (команда, а не кнопка) или Telegram не даёт (сообщение без текста, старое).
+# Все правки сообщений с меню идут через show_screen — иначе хэш устареет.
+SCREEN_HASHES_LIMIT = 20  # сообщений одного чата, для которых помним экран
+
+
+def screen_hash(text, reply_markup, disable_web_page_preview):
+    markup = reply_markup.to_json() if reply_markup else ""
+    return hashlib.sha1(f"{text}\0{markup}\0{disable_web_page_preview}".encode()).hexdigest()
+
+
+def remember_screen(context, message_id, digest):
+    screens = context.chat_data.setdefault("screens", {})
+    screens.pop(message_id, None)
+    screens[message_id] = digest
+    while len(screens) > SCREEN_HASHES_LIMIT:
+        del screens[next(iter(screens))]  # самое давнее сообщение
+
+
+async def show_screen(update, context, text, reply_markup=None, disable_web_page_preview=False):
+    message = update.callback_query.message if update.callback_query else None
+    digest = screen_hash(text, reply_markup, disable_web_page_preview)
+    if message is not None and context.chat_data is not None:
+        if context.chat_data.get("screens", {}).get(message.message_id) == digest:
+            metrics.SCREEN_UPDATES.inc(result="unchanged")
+            return
+        try:
+            await message.edit_text(
+                text, parse_mode="HTML", reply_markup=reply_markup,
+                disable_web_page_preview=disable_web_page_preview
+            )
+            metrics.SCREEN_UPDATES.inc(result="edited")
+            remember_screen(context, message.message_id, digest)
+            return
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                # Экран уже такой (например, показан до рестарта) — запоминаем и выходим
+                metrics.SCREEN_UPDATES.inc(result="unchanged")
+                remember_screen(context, message.message_id, digest)
+                return
+            logging.info(f"Сообщение {message.message_id} не редактируется ({e}), отправляем новое.")
+
+    sent = await send_html_with_logging(
+        context.bot, update.effective_chat.id, text,
+        reply_markup=reply_markup, disable_web_page_preview=disable_web_page_preview
+    )
+    metrics.SCREEN_UPDATES.inc(result="sent")
+    if sent is not None and context.chat_data is not None:
+        remember_screen(context, sent.message_id, digest)
 
 # ——————————————————————————————————————————————————————————
 # Main menu keyboard
 
+MAIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("ℹ️ О подкасте «Чё там новости?»", callback_data="about")],
+    [InlineKeyboardButton("❓ FAQ или Часто задаваемые вопросы", callback_data="faq")],
+    [InlineKeyboardButton("🎧 Свежие выпуски подкаста", callback_data="latest")],
+    [InlineKeyboardButton("📚 Архив выпусков", callback_data="arc:0")],
+    [InlineKeyboardButton("🎲 Случайный выпуск", callback_data="random")],
+    [InlineKeyboardButton("🔍 Поиск по эпизодам", callback_data="search")],
+    [InlineKeyboardButton("🔔 Подписка на новые выпуски", callback_data="sub")],
+    [InlineKeyboardButton("📱 Где нас слушать?", callback_data="platforms")],
+    [InlineKeyboardButton("💡 Предложить новость или тему", callback_data="suggest")],
+    [InlineKeyboardButton("👤 Хочу стать гостем", callback_data="guest")],
+    [InlineKeyboardButton("📬 Контакты", callback_data="contact")]
+])
+
+
 def get_main_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("ℹ️ О подкасте «Чё там новости?»", callback_data="about")],
-        [InlineKeyboardButton("❓ FAQ или Часто задаваемые вопросы", callback_data="faq")],
-        [InlineKeyboardButton("🎧 Свежие выпуски подкаста", callback_data="latest")],
-        [InlineKeyboardButton("🎲 Случайный выпуск", callback_data="random")],
-        [InlineKeyboardButton("🔍 Поиск по эпизодам", callback_data="search")],
-        [InlineKeyboardButton("📱 Где нас слушать?", callback_data="platforms")],
-        [InlineKeyboardButton("💡 Предложить новость или тему", callback_data="suggest")],
-        [InlineKeyboardButton("👤 Хочу стать гостем", callback_data="guest")],
-        [InlineKeyboardButton("📬 Контакты", callback_data="contact")]
-    ])
+    return MAIN_MENU
 
 # ——————————————————————————————————————————————————————————
 # ХЭНДЛЕРЫ КОМАНД
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def log_action(update: Update, action: str):
+    # Пользователь и событие уходят в буфер; в базу — пачкой, вне обработки кнопки
     user = update.effective_user
+    if not user:
+        return
     now = datetime.utcnow().isoformat()  # Используем UTC для унифицированного времени
+    db.queue_user(user.id, user.username, user.first_name, now)
+    db.queue_action(user.id, action, now)
 
-    # Сохраняем данные пользователя в базе
-    await insert_user_data(user.id, user.username, user.first_name, now, update, context)
+
+async def flush_pending_writes(context):
+    await db.flush_pending_writes()
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Сохраняем данные пользователя (и обновляем last_seen)
+    log_action(update, "start")
 
     # Отправляем главное меню после регистрации пользователя
     await update.message.reply_text(
         "Добро пожаловать! Выберите одно из действий ниже:",
         reply_markup=get_main_menu()  # Главное меню с кнопками
     )
-async def insert_user_data(user_id, username, first_name, last_seen, update, context):
-    try:
-        async with aiosqlite.connect("users.db") as db:
-            # Проверяем, существует ли уже пользователь в базе данных
-            cursor = await db.execute("""
-                SELECT COUNT(*) FROM users WHERE user_id = ?
-            """, (user_id,))
-            count = await cursor.fetchone()
-            
-            if count[0] == 0:
-                # Если пользователя нет, добавляем его
-                await db.execute("""
-                    INSERT INTO users (user_id, username, first_name, last_seen)
-                    VALUES (?, ?, ?, ?)
-                """, (user_id, username, first_name, last_seen))
-                await db.commit()
-                logging.info(f"Пользователь {user_id} добавлен в базу данных.")
-            else:
-                logging.info(f"Пользователь {user_id} уже существует в базе данных.")
-            
-    except Exception as e:
-        logging.error(f"Ошибка вставки данных пользователя {user_id}: {e}")
+# ---------- ФУНКЦИИ ПОКАЗА ----------
+ABOUT_TEXT = (
+    "ℹ️ <b>«Чё там новости?»</b> — это подкаст, где ведущие Катя и Таня делятся позитивными и неожиданными новостями,"
+    "глядя на происходящее с разных сторон.\nБез негатива, с юмором и теплотой.\n"
+    f"Больше — на сайте: {PODCAST_LINK}"
+)
+
+FAQ_TEXT = (
+    "❓ <b>FAQ или Часто задаваемые вопросы:</b>\n\n"
+    "📍 <b>Где можно послушать наш подкаст?</b>\n"
+    "На всех возможных платформах. Подробнее по кнопке «📱 Где слушать?»\n\n"
+    "💡 <b>Можно ли предложить вам тему?</b>\n"
+    "Да, конечно! Заполните форму по кнопке «💡 Предложить тему»\n\n"
+    "👤 <b>Бывают ли у вас в подкасте гости?</b>\n"
+    "Да. Мы любим общаться с интересными людьми.\n\n"
+    "📆 <b>Как часто выходят выпуски?</b>\n"
+    "Раз в неделю. Обычно по вторникам.\n\n"
+    "🎙 <b>Как зовут ведущих?</b>\n"
+    "Катя и Таня. А ещё иногда в микрофон посапывает корги по имени Марти.\n"
+)
 
 
-# ---------- ФУНКЦИИ ПОКАЗА ----------
 async def show_about(update, context):
-    text = (
-        "ℹ️ <b>«Чё там новости?»</b> — это подкаст, где ведущие Катя и Таня делятся позитивными и неожиданными новостями,"
-        "глядя на происходящее с разных сторон.\nБез негатива, с юмором и теплотой.\n"
-        f"Больше — на сайте: {PODCAST_LINK}"
-    )
-    await send_html_with_logging(context.bot, update.effective_chat.id, text, reply_markup=get_back_button())
+    await show_screen(update, context, ABOUT_TEXT, reply_markup=get_back_button())
 
 
 async def show_faq(update, context):
-    text = (
-        "❓ <b>FAQ или Часто задаваемые вопросы:</b>\n\n"
-        "📍 <b>Где можно послушать наш подкаст?</b>\n"
-        "На всех возможных платформах. Подробнее по кнопке «📱 Где слушать?»\n\n"
-        "💡 <b>Можно ли предложить вам тему?</b>\n"
-        "Да, конечно! Заполните форму по кнопке «💡 Предложить тему»\n\n"
-        "👤 <b>Бывают ли у вас в подкасте гости?</b>\n"
-        "Да. Мы любим общаться с интересными людьми.\n\n"
-        "📆 <b>Как часто выходят выпуски?</b>\n"
-        "Раз в неделю. Обычно по вторникам.\n\n"
-        "🎙 <b>Как зовут ведущих?</b>\n"
-        "Катя и Таня. А ещё иногда в микрофон посапывает корги по имени Марти.\n"
-    )
-    await send_html_with_logging(context.bot, update.effective_chat.id, text, reply_markup=get_back_button())
+    await show_screen(update, context, FAQ_TEXT, reply_markup=get_back_button())
 
 
 # ---------- ПОСЛЕДНИЕ ЭПИЗОДЫ ----------
 async def show_latest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        eps = await fetch_episodes_from_rss()
-        logging.info(f"Fetched {len(eps)} episodes")
+        eps = await get_episodes()
     except Exception as e:
         logging.error(f"Ошибка при получении данных из RSS: {e}")
         target = update.message or update.callback_query.message
@@ -315,24 +853,83 @@ async def show_latest(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_back_button()
         )
 
-    chat_id = update.effective_chat.id if update.message else update.callback_query.message.chat.id
-    last3 = eps[-3:][::-1]
-    text = "🎙 <b>Три последних эпизода:</b>\n"
-    for title, url, _ in last3:  # Мы не используем описание, поэтому заменили на "_"
-        text += f"🔹 <b><a href=\"{url}\">{title}</a></b>\n"
-
-    await send_html_with_logging(
-        context.bot, chat_id, text,
+    await show_screen(
+        update, context, get_feed().latest_text,
         reply_markup=get_back_button(),
         disable_web_page_preview=True
     )
 
 
+# ---------- АРХИВ ВЫПУСКОВ ----------
+# Листалка по всему каталогу. Страницы (текст + клавиатура) собираются в
+# refresh_render_cache один раз на версию ленты, свежие выпуски — первыми,
+# поэтому клик по «▶️» — это один edit_message_text без похода в RSS,
+# сортировки и форматирования. callback_data — "arc:<страница>".
+ARCHIVE_PAGE_SIZE = 10
+ARCHIVE_HEADER = "📚 <b>Архив выпусков:</b>\n"
+
+
+def page_keyboard(prefix, page, pages):
+    # ◀️ 2/15 ▶️ и «Назад»; одна страница — только «Назад»
+    if pages < 2:
+        return get_back_button()
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"{prefix}:{page - 1}"))
+    nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"{prefix}:{page}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"{prefix}:{page + 1}"))
+    return InlineKeyboardMarkup([nav, [InlineKeyboardButton("⬅️ Назад", callback_data="back")]])
+
+
+def build_pages(header, lines, prefix, page_size):
+    # [(текст, клавиатура)] по page_size строк на страницу
+    chunks = [lines[i:i + page_size] for i in range(0, len(lines), page_size)]
+    return [
+        (header + "\n".join(chunk), page_keyboard(prefix, page, len(chunks)))
+        for page, chunk in enumerate(chunks)
+    ]
+
+
+def archive_line(ep):
+    date = f" · {ep.published:%d.%m.%Y}" if ep.published else ""
+    return f"🔹 <a href=\"{escape(ep.url, quote=True)}\">{escape(ep.title)}</a>{date}"
+
+
+def build_archive_pages(episodes):
+    return build_pages(ARCHIVE_HEADER, [archive_line(ep) for ep in episodes[::-1]], "arc", ARCHIVE_PAGE_SIZE)
+
+
+def parse_page(data: str) -> int:
+    # "arc:3" или "srch:<id>:3" -> 3
+    try:
+        return max(0, int(data.rsplit(":", 1)[1]))
+    except (IndexError, ValueError):
+        return 0
+
+
+async def show_page(update, context, pages, page):
+    # Меняем сообщение с кнопками на нужную страницу; номер за пределами — последняя.
+    # Нажатие на номер текущей страницы show_screen отсечёт по хэшу
+    text, keyboard = pages[min(page, len(pages) - 1)]
+    await show_screen(update, context, text, reply_markup=keyboard, disable_web_page_preview=True)
+
+
+async def show_archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    feed = get_feed()
+    await get_episodes(feed)
+    if not feed.archive_pages:
+        return await update.callback_query.message.reply_text(
+            "❌ Нет доступных эпизодов.",
+            reply_markup=get_back_button()
+        )
+    await show_page(update, context, feed.archive_pages, parse_page(update.callback_query.data))
+
+
 # ---------- СЛУЧАЙНЫЙ ЭПИЗОД ----------
 async def show_random(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        eps = await fetch_episodes_from_rss()
-        logging.info(f"Fetched {len(eps)} episodes")
+        eps = await get_episodes()
     except Exception as e:
         logging.error(f"Ошибка при получении данных из RSS: {e}")
         target = update.message or update.callback_query.message
@@ -349,21 +946,11 @@ async def show_random(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     try:
-        title, url, description = random.choice(eps)
-        desc = clean_html(description)
-        text = f"🎲 <b>Случайный эпизод:\n\n🔹 <a href=\"{url}\">{title}</a></b>"
-        if desc:
-            text += f"\n\n<i>{desc}</i>"
-
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔁 Другой случайный эпизод", callback_data="random")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
-        ])
+        text = get_rendered(random.choice(eps)).random_text
+        kb = RANDOM_KEYBOARD
 
-        if update.message:
-            await update.message.reply_text(text, parse_mode="HTML", reply_markup=kb, disable_web_page_preview=True)
-        else:
-            await update.callback_query.message.reply_text(text, parse_mode="HTML", reply_markup=kb, disable_web_page_preview=True)
+        # «🔁 Другой случайный эпизод» меняет этот же экран
+        await show_screen(update, context, text, reply_markup=kb, disable_web_page_preview=True)
     
     except Exception as e:
         logging.error(f"Ошибка при обработке случайного эпизода: {e}")
@@ -375,18 +962,21 @@ async def show_random(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Хэндлер для кнопки "Поиск"
 async def search_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_action(update, "search")
     await update.callback_query.answer()
-    await update.callback_query.message.reply_text(
-        "🔍 Введите слово для поиска:",
-        reply_markup=get_back_button()
-    )
+    await show_screen(update, context, "🔍 Введите слово для поиска:", reply_markup=get_back_button())
     context.user_data['in_search'] = True
 
 
 # Функция для поиска по названиям и описаниям с проверкой наличия описания
 # Список слов, по которым не будем искать
 EXCLUDED_WORDS = ["хуй", "пизда", "херня", "блядь", "сука", "херня", "хер", "пиздец"]
-MAX_RESULTS = 10  # Максимальное количество эпизодов, которое мы показываем
+MAX_RESULTS = 10  # Эпизодов на одной странице результатов
+SEARCH_MAX_RESULTS = 100  # Всего результатов поиска, дальше — просим уточнить запрос
+
+def format_snippet(snippet: str) -> str:
+    # Экранируем текст сниппета и превращаем маркеры совпадений в <b>
+    return escape(snippet).replace(db.SNIPPET_START, "<b>").replace(db.SNIPPET_END, "</b>")
 
 async def handle_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("🔥 handle_search called with text: %r", update.message.text)
@@ -394,29 +984,19 @@ async def handle_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.pop('in_search', None)
     
     query = update.message.text.strip().lower()
+    log_action(update, "search_query")
 
     # Проверяем, есть ли в запросе одно из исключённых слов
-    if any(excluded_word in query for excluded_word in EXCLUDED_WORDS):
+    if SEARCH_RULES.search(query):
         return await update.message.reply_text("Ваш запрос содержит запрещённые слова. Попробуйте переформулировать запрос.")
 
-    # Получаем эпизоды
-    try:
-        eps = await fetch_episodes_from_rss()  # Получаем эпизоды из RSS
-        logging.info(f"Fetched {len(eps)} episodes")
-    except Exception as e:
-        logging.error(f"Ошибка при получении данных из RSS: {e}")
-        return await update.message.reply_text("Произошла ошибка при поиске эпизодов. Попробуйте позже.")
+    # Один запрос к полнотекстовому индексу каталога, лучшие совпадения — первыми
+    results = await db.search_episodes(query, SEARCH_MAX_RESULTS + 1, get_feed().id)
 
-    # Поиск по заголовкам и описаниям
-    results = []
-    for title, url, description in eps:
-        if query in title.lower() or query in description.lower():
-            results.append((title, url))
-
-    # Если найдено больше результатов, чем MAX_RESULTS
-    if len(results) > MAX_RESULTS:
-        results = results[:MAX_RESULTS]  # Ограничиваем количество результатов
-        await update.message.reply_text("Найдено слишком много эпизодов. Пожалуйста, уточните запрос.")
+    # Если найдено больше результатов, чем SEARCH_MAX_RESULTS
+    if len(results) > SEARCH_MAX_RESULTS:
+        results = results[:SEARCH_MAX_RESULTS]  # Ограничиваем количество результатов
+        await update.message.reply_text("Найдено слишком много эпизодов, показаны лучшие совпадения. Уточните запрос.")
 
     # Если не найдено ни одного результата
     if not results:
@@ -425,15 +1005,30 @@ async def handle_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_back_button()
         )
     else:
-        text = "🎙 <b>Результаты поиска:</b>\n" + "\n".join(
-            f"🔹 <a href=\"{url}\">{title}</a>" for title, url in results
-        )
+        lines = [
+            f"🔹 <a href=\"{escape(url, quote=True)}\">{escape(title)}</a>" + (f"\n<i>{format_snippet(snippet)}</i>" if snippet else "")
+            for title, url, snippet, _ in results
+        ]
+        # Страницы собираем сразу и держим в user_data: листание — только edit.
+        # id поиска в callback_data отличает кнопки старых результатов от свежих
+        search_id = update.message.message_id
+        pages = build_pages("🎙 <b>Результаты поиска:</b>\n", lines, f"srch:{search_id}", MAX_RESULTS)
+        context.user_data['search_pages'] = (search_id, pages)
+        text, keyboard = pages[0]
         await update.message.reply_text(
-            text, parse_mode="HTML", reply_markup=get_back_button(),
+            text, parse_mode="HTML", reply_markup=keyboard,
             disable_web_page_preview=True
         )
 
-    return ConversationHandler.END  # выходим из состояния SEARCH
+
+async def show_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Листание результатов поиска: "srch:<id поиска>:<страница>"
+    query = update.callback_query
+    search_id, pages = context.user_data.get('search_pages', (None, None))
+    if not pages or query.data.split(":")[1:2] != [str(search_id)]:
+        return await show_screen(update, context, "Результаты поиска устарели. Повторите поиск.", reply_markup=get_back_button())
+    await show_page(update, context, pages, parse_page(query.data))
+
 
 async def cancel_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Пользователь нажал «⬅️ Назад» в процессе поиска
@@ -442,15 +1037,132 @@ async def cancel_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.message.delete()
     return await start(update, context)
 
+
+# ---------- INLINE-ПОИСК ----------
+# @бот <запрос> в любом чате: ответ собирается из того же FTS-индекса и готовых
+# текстов эпизодов. Telegram сам кэширует ответ на INLINE_CACHE_TIME, а у нас
+# результаты запроса живут в LRU до следующей версии ленты — при наборе
+# запроса и пролистывании страниц база не дёргается повторно.
+INLINE_PAGE_SIZE = 20          # результатов в одном ответе
+INLINE_MAX_RESULTS = 100       # всего результатов на запрос (5 страниц)
+INLINE_CACHE_TIME = 300        # секунд кэша на стороне Telegram
+INLINE_CACHE_SIZE = 512        # запросов в локальном LRU
+INLINE_DESCRIPTION_LIMIT = 120
+
+
+class LRUCache:
+    # Небольшой LRU на OrderedDict: самый старый ключ вытесняется первым
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+_inline_cache = LRUCache(INLINE_CACHE_SIZE)
+
+
+def normalize_inline_query(query: str) -> str:
+    # «Ёжик  в тумане» и «ежик в тумане» — один ключ кэша
+    return " ".join(db.normalize_search_text(query).lower().split())
+
+
+async def find_inline_episodes(feed, query: str):
+    # [(эпизод, сниппет)] для запроса; пустой запрос — свежие выпуски
+    key = (feed.id, feed.digest, query)
+    cached = _inline_cache.get(key)
+    if cached is not None:
+        metrics.CACHE_REQUESTS.inc(cache="inline", result="hit")
+        return cached
+    metrics.CACHE_REQUESTS.inc(cache="inline", result="miss")
+
+    if not query:
+        found = [(ep, "") for ep in feed.episodes[::-1][:INLINE_MAX_RESULTS]]
+    elif SEARCH_RULES.search(query):
+        found = []
+    else:
+        rows = await db.search_episodes(query, INLINE_MAX_RESULTS, feed.id)
+        found = [(feed.by_guid[guid], snippet) for _, _, snippet, guid in rows if guid in feed.by_guid]
+    _inline_cache.put(key, found)
+    return found
+
+
+def inline_article(ep, snippet, feed):
+    rendered = get_rendered(ep, feed)
+    if snippet:
+        description = snippet.replace(db.SNIPPET_START, "").replace(db.SNIPPET_END, "")
+    else:
+        description = rendered.description
+    return InlineQueryResultArticle(
+        id=hashlib.sha1(f"{feed.id}:{ep.guid}".encode()).hexdigest(),  # id — не длиннее 64 байт
+        title=ep.title,
+        description=truncate_text(" ".join(description.split()), INLINE_DESCRIPTION_LIMIT),
+        url=ep.url,
+        input_message_content=InputTextMessageContent(rendered.share_text, parse_mode="HTML"),
+    )
+
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    try:
+        offset = int(query.offset or 0)
+    except ValueError:
+        offset = 0
+    if not offset:
+        # Следующие страницы — то же действие, в статистику не пишем
+        log_action(update, "inline_query")
+
+    try:
+        feed = get_feed()
+        await get_episodes(feed)
+        found = await find_inline_episodes(feed, normalize_inline_query(query.query))
+        page = found[offset:offset + INLINE_PAGE_SIZE]
+        next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(found) else ""
+        await query.answer(
+            [inline_article(ep, snippet, feed) for ep, snippet in page],
+            cache_time=INLINE_CACHE_TIME,
+            next_offset=next_offset,
+        )
+    except Exception as e:
+        logging.error(f"Ошибка inline-поиска по запросу {query.query!r}: {e}")
+
+
 # Функция для отображения платформ
+# Клавиатуры со ссылками не меняются — собираем их один раз
+# (ссылки на платформы — свои у каждой ленты, см. Feed.platforms_keyboard)
+SUGGEST_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 Форма", url="https://forms.gle/vb5meoNmCBXXhfcs8")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
+])
+GUEST_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 Анкета", url="https://forms.gle/MeXh6x3GemufBGmu9")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
+])
+CONTACT_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🌐 Написать через форму на сайте", url="https://chetamnovosti.ru/contact")],
+    [InlineKeyboardButton("💬 Написать в ВК", url="https://vk.com/che_tam_novosti")],
+    [InlineKeyboardButton("💬 Наш Инстаграм", url="https://instagram.com/che_tam_novosti/")],
+    [InlineKeyboardButton("💬 Комментарии в Telegram", url="https://t.me/CheTamNovosti")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
+])
+
+
 async def show_platforms(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        kb = InlineKeyboardMarkup(
-            [[InlineKeyboardButton(name, url=url)] for name, url in PLATFORM_LINKS] + [[InlineKeyboardButton("⬅️ Назад", callback_data="back")]]
-        )
-        
+        kb = get_feed().platforms_keyboard
+
         # Отправляем информацию с кнопками
-        await send_html_with_logging(context.bot, update.effective_chat.id, "📱 Где слушать подкаст?", reply_markup=kb)
+        await show_screen(update, context, "📱 Где слушать подкаст?", reply_markup=kb)
     
     except Exception as e:
         logging.error(f"Ошибка при создании платформ для пользователя {update.effective_user.id}: {e}")
@@ -459,13 +1171,10 @@ async def show_platforms(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Функция для отображения формы предложений
 async def show_suggest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📋 Форма", url="https://forms.gle/vb5meoNmCBXXhfcs8")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
-        ])
-        
+        kb = SUGGEST_KEYBOARD
+
         # Отправляем информацию с кнопками
-        await send_html_with_logging(context.bot, update.effective_chat.id, "💡 Есть идея для нашего выпуска? Заполните форму:", reply_markup=kb)
+        await show_screen(update, context, "💡 Есть идея для нашего выпуска? Заполните форму:", reply_markup=kb)
     
     except Exception as e:
         logging.error(f"Ошибка при отображении формы предложений для пользователя {update.effective_user.id}: {e}")
@@ -474,13 +1183,10 @@ async def show_suggest(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Функция для отображения анкеты для гостей
 async def show_guest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📋 Анкета", url="https://forms.gle/MeXh6x3GemufBGmu9")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
-        ])
-        
+        kb = GUEST_KEYBOARD
+
         # Отправляем информацию с кнопками
-        await send_html_with_logging(context.bot, update.effective_chat.id, "👤 Хотите стать гостем? Заполните анкету:", reply_markup=kb)
+        await show_screen(update, context, "👤 Хотите стать гостем? Заполните анкету:", reply_markup=kb)
     
     except Exception as e:
         logging.error(f"Ошибка при отображении анкеты для гостей для пользователя {update.effective_user.id}: {e}")
@@ -489,73 +1195,346 @@ async def show_guest(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Функция для отображения контактной информации
 async def show_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🌐 Написать через форму на сайте", url="https://chetamnovosti.ru/contact")],
-            [InlineKeyboardButton("💬 Написать в ВК", url="https://vk.com/che_tam_novosti")],
-            [InlineKeyboardButton("💬 Наш Инстаграм", url="https://instagram.com/che_tam_novosti/")],
-            [InlineKeyboardButton("💬 Комментарии в Telegram", url="https://t.me/CheTamNovosti")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back")]
-        ])
-        
+        kb = CONTACT_KEYBOARD
+
         # Отправляем информацию с кнопками
-        await send_html_with_logging(context.bot, update.effective_chat.id, "📬 Связаться с нами можно так:", reply_markup=kb)
+        await show_screen(update, context, "📬 Связаться с нами можно так:", reply_markup=kb)
     
     except Exception as e:
         logging.error(f"Ошибка при отображении контактов для пользователя {update.effective_user.id}: {e}")
         await send_html_with_logging(context.bot, update.effective_chat.id, "❌ Произошла ошибка при отображении контактов. Попробуйте позже.")
         
         
+# ---------- ПОДПИСКА НА ВЫПУСКИ ----------
+# Подписчики получают новые выпуски в личку (см. create_broadcast_job).
+# /subscribe и /unsubscribe принимают slug ленты, без него — лента по умолчанию;
+# кнопка в меню переключает подписку на ленту по умолчанию.
+def subscription_screen(feed, active):
+    if active:
+        text = f"🔔 Вы подписаны на новые выпуски «{escape(feed.title)}». Пришлём их сюда, как только выйдут."
+        button = InlineKeyboardButton("🔕 Отписаться", callback_data=f"sub:off:{feed.slug}")
+    else:
+        text = f"🔕 Подписка на новые выпуски «{escape(feed.title)}» выключена."
+        button = InlineKeyboardButton("🔔 Подписаться", callback_data=f"sub:on:{feed.slug}")
+    return text, InlineKeyboardMarkup([[button], [InlineKeyboardButton("⬅️ Назад", callback_data="back")]])
+
+
+async def subscription_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # "sub" — показать состояние, "sub:on:<slug>" / "sub:off:<slug>" — переключить
+    query = update.callback_query
+    _, change, slug = (query.data.split(":") + ["", ""])[:3]
+    feed = get_feed(slug) or get_feed()
+    user_id = update.effective_user.id
+    try:
+        if change in ("on", "off"):
+            await db.set_subscription(user_id, feed.id, change == "on")
+            active = change == "on"
+        else:
+            active = await db.is_subscribed(user_id, feed.id)
+    except Exception as e:
+        logging.error(f"Ошибка при изменении подписки пользователя {user_id}: {e}")
+        return await query.message.reply_text("❌ Не удалось изменить подписку. Попробуйте позже.")
+    text, keyboard = subscription_screen(feed, active)
+    await show_screen(update, context, text, reply_markup=keyboard)
+
+
+async def change_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE, active: bool):
+    log_action(update, "subscribe" if active else "unsubscribe")
+    slug = context.args[0] if context.args else None
+    feed = get_feed(slug)
+    if feed is None:
+        return await update.message.reply_text(
+            f"Такого подкаста нет. Доступны: {', '.join(sorted(FEEDS))}",
+            reply_markup=get_back_button()
+        )
+    user_id = update.effective_user.id
+    try:
+        await db.set_subscription(user_id, feed.id, active)
+    except Exception as e:
+        logging.error(f"Ошибка при изменении подписки пользователя {user_id}: {e}")
+        return await update.message.reply_text("❌ Не удалось изменить подписку. Попробуйте позже.")
+    logging.info(f"Пользователь {user_id} {'подписался на' if active else 'отписался от'} ленту {feed.slug}.")
+    text, keyboard = subscription_screen(feed, active)
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=keyboard)
+
+
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await change_subscription(update, context, True)
+
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await change_subscription(update, context, False)
+
+
 # ---------- МОДЕРАЦИЯ ----------
 
-BANNED_WORDS = {"http://", "https://", "www.", "купить", "скидка", "spam", "хуй", "бляд", "еба", "пизд", "пидар", "хуй", "херня", "сука", "херня", "хер", "пиздец", "сука", "хуев", "пезд", "пидор"}
-PHONE_RE = re.compile(r"(?:\+7|8)[\s\-]?\(?9\d{2}\)?[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}")
+# Значения по умолчанию; рабочие правила живут в таблице moderation_rules
+BANNED_WORDS = {"купить", "скидка", "spam", "хуй", "бляд", "еба", "пизд", "пидар", "хуй", "херня", "сука", "херня", "хер", "пиздец", "сука", "хуев", "пезд", "пидор"}
+LINK_PATTERNS = [r"https?://", r"www\."]
+PHONE_PATTERN = r"(?:\+7|8)[\s\-]?\(?9\d{2}\)?[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}"
+RULES_RELOAD_INTERVAL = 300  # секунд
+
+# Латиница и цифры, похожие на кириллицу: «xyй», «cyкa», «3ло» и т.п.
+HOMOGLYPHS = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м", "o": "о",
+    "p": "р", "t": "т", "x": "х", "y": "у", "0": "о", "3": "з", "6": "б", "@": "а", "ё": "е"
+})
+# «х.у.й», «х*й» — разделители внутри слова
+INNER_SEPARATORS_RE = re.compile(r"(?<=\w)[.\-_*|~+'`\"]+(?=\w)")
+# «х у й» — слово, разбитое на отдельные буквы одинаковыми пробелами (от трёх букв).
+# Обычный текст тоже бывает таким («а я и ты»), поэтому склеенный отрывок
+# проверяется отдельно и с соседними словами не сливается
+SPACED_LETTERS_RE = re.compile(r"\b\w\b(?P<sep>\s+)\w\b(?:(?P=sep)\w\b)+")
+# «хуууй» — растянутые буквы
+REPEATS_RE = re.compile(r"(\w)\1+")
+
+
+def normalize_for_rules(text: str) -> str:
+    # Приводит текст и правила к одному виду, чтобы обходы фильтра не работали
+    text = (text or "").lower().translate(HOMOGLYPHS)
+    text = INNER_SEPARATORS_RE.sub("", text)
+    return REPEATS_RE.sub(r"\1", text)
+
+
+def spaced_words(normalized: str):
+    # Слова, набранные вразбивку, — склеенные, каждое само по себе
+    for match in SPACED_LETTERS_RE.finditer(normalized):
+        yield REPEATS_RE.sub(r"\1", "".join(match.group().split()))
+
+
+def build_trie_pattern(words):
+    # Собирает слова в префиксное дерево и превращает его в одну регулярку:
+    # общие префиксы проверяются один раз, сколько бы слов ни было в списке
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def to_pattern(node):
+        branches = [re.escape(ch) + to_pattern(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        if "" in node:
+            # Слово уже закончилось — продолжение необязательно
+            return "(?:" + "|".join(branches) + ")?"
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+
+    return to_pattern(trie)
+
+
+class RuleMatcher:
+    # Набор правил, скомпилированный в две регулярки: слова ищутся по
+    # нормализованному тексту, шаблоны (ссылки, телефоны) — по исходному
+    def __init__(self, words=(), patterns=()):
+        words = {normalize_for_rules(word) for word in words if word.strip()}
+        self.word_re = re.compile(build_trie_pattern(sorted(words))) if words else None
+
+        valid = []
+        for pattern in patterns:
+            try:
+                re.compile(pattern)
+                valid.append(f"(?:{pattern})")
+            except re.error as e:
+                logging.error(f"Некорректный шаблон модерации {pattern!r}: {e}")
+        self.raw_re = re.compile("|".join(valid)) if valid else None
+        self.size = len(words) + len(valid)
+
+    def search(self, text: str):
+        # Возвращает сработавший фрагмент или None
+        lowered = (text or "").lower()
+        if self.raw_re:
+            match = self.raw_re.search(lowered)
+            if match:
+                return match.group()
+        if self.word_re:
+            normalized = normalize_for_rules(lowered)
+            match = self.word_re.search(normalized)
+            if match:
+                return match.group()
+            for word in spaced_words(normalized):
+                match = self.word_re.search(word)
+                if match:
+                    return match.group()
+        return None
+
+
+MODERATION_RULES = RuleMatcher(BANNED_WORDS, LINK_PATTERNS + [PHONE_PATTERN])
+SEARCH_RULES = RuleMatcher(EXCLUDED_WORDS)
+
+
+def default_rules():
+    return (
+        [("word", word) for word in sorted(BANNED_WORDS)]
+        + [("regex", pattern) for pattern in LINK_PATTERNS + [PHONE_PATTERN]]
+        + [("search", word) for word in sorted(set(EXCLUDED_WORDS))]
+    )
+
+
+async def reload_moderation_rules(context=None):
+    # Перечитывает правила из базы; при ошибке остаются прежние
+    global MODERATION_RULES, SEARCH_RULES
+    rows = await db.load_moderation_rules()
+    if rows is None:
+        return False
+    by_kind = {"word": [], "regex": [], "search": []}
+    for kind, pattern in rows:
+        by_kind.setdefault(kind, []).append(pattern)
+    MODERATION_RULES = RuleMatcher(by_kind["word"], by_kind["regex"])
+    SEARCH_RULES = RuleMatcher(by_kind["search"])
+    logging.info(f"Правила модерации загружены: {MODERATION_RULES.size}, для поиска: {SEARCH_RULES.size}.")
+    return True
+
+
+async def reloadrules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_action(update, "reloadrules")
+    if update.effective_user.id not in ADMINS:
+        await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
+        return
+    if await reload_moderation_rules():
+        await update.message.reply_text(
+            f"✅ Правила перечитаны: модерация — {MODERATION_RULES.size}, поиск — {SEARCH_RULES.size}."
+        )
+    else:
+        await update.message.reply_text("❌ Не удалось прочитать правила из базы.")
+
+
+# Кэш админов по чатам: chat_id -> (множество user_id, момент устаревания).
+# Загружается одним запросом get_chat_administrators и сбрасывается, когда
+# приходит ChatMemberUpdated с изменением прав.
+ADMIN_CACHE_TTL = 600  # секунд
+ADMIN_STATUSES = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+_admin_cache = {}
+_admin_locks = {}    # chat_id -> замок загрузки: при флуде список грузится один раз
+
+
+async def get_chat_admin_ids(bot, chat):
+    # В личке админов нет, и API там не дёргаем
+    if chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
+        return frozenset()
+
+    lock = _admin_locks.setdefault(chat.id, asyncio.Lock())
+    async with lock:
+        now = asyncio.get_running_loop().time()
+        cached = _admin_cache.get(chat.id)
+        if cached and cached[1] > now:
+            metrics.CACHE_REQUESTS.inc(cache="chat_admins", result="hit")
+            return cached[0]
+
+        metrics.CACHE_REQUESTS.inc(cache="chat_admins", result="miss")
+        admins = await bot.get_chat_administrators(chat.id)
+        admin_ids = frozenset(member.user.id for member in admins)
+        _admin_cache[chat.id] = (admin_ids, now + ADMIN_CACHE_TTL)
+        return admin_ids
+
+
+async def track_chat_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Кого-то назначили или сняли с админов — кэш этого чата больше не верен
+    member_update = update.chat_member or update.my_chat_member
+    old_status = member_update.old_chat_member.status
+    new_status = member_update.new_chat_member.status
+    if old_status != new_status and (old_status in ADMIN_STATUSES or new_status in ADMIN_STATUSES):
+        _admin_cache.pop(member_update.chat.id, None)
+        logging.info(f"Кэш админов чата {member_update.chat.id} сброшен.")
+
+
+# Сообщения, которые проходят модерацию; процессор апдейтов проверяет их тем же фильтром
+MODERATED_MESSAGES = filters.TEXT & ~filters.COMMAND & ~filters.StatusUpdate.NEW_CHAT_MEMBERS
+
+
+def moderation_violation(msg):
+    # Проверка на запрещённые слова, ссылки и номера — без запросов к API
+    return MODERATION_RULES.search((msg.text or "").lower())
+
 
 async def moderate_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Если мы сейчас в режиме поиска — пропускаем
     if context.user_data.get('in_search'):
         logging.info("🛑 Skipping moderation because we are in search mode")
         return
-    
-    msg = update.message
+
+    # Чистые сообщения дальше не идут
+    violation = moderation_violation(update.message)
+    if violation:
+        await moderate_message(context.bot, update.message, violation)
+
+
+async def moderate_message(bot, msg, violation):
     user = msg.from_user
     chat_id = msg.chat.id
 
-    # 1) Проверяем статус участника (строка)
-    member = await context.bot.get_chat_member(chat_id, user.id)
-    if member.status in ("administrator", "creator"):
-        # админы и создатель не модеруются
+    # Админы и создатель не модеруются (статус берём из кэша)
+    try:
+        if user.id in await get_chat_admin_ids(bot, msg.chat):
+            return
+    except Exception as e:
+        logging.error(f"Ошибка при получении админов чата {chat_id}: {e}")
         return
 
-    text = (msg.text or "").lower()    
+    try:
+        # Удаляем сообщение
+        await msg.delete()
+        metrics.MODERATION_DELETED.inc()
 
+        # Ограничиваем пользователя на 10 минут
+        #await bot.restrict_chat_member(
+        #    chat_id=chat_id,
+        #    user_id=user.id,
+        #    permissions=ChatPermissions(can_send_messages=False),
+        #    until_date=datetime.utcnow() + timedelta(minutes=10)
+        #)
 
-    # 2) Проверка на запрещённые слова и номера
-    if any(bad in text for bad in BANNED_WORDS) or PHONE_RE.search(text):
-        try:
-            # Удаляем сообщение
-            await msg.delete()
-
-            # Ограничиваем пользователя на 10 минут
-            #await context.bot.restrict_chat_member(
-            #    chat_id=chat_id,
-            #    user_id=user.id,
-            #    permissions=ChatPermissions(can_send_messages=False),
-            #    until_date=datetime.utcnow() + timedelta(minutes=10)
-            #)
-
-            # Отправляем предупреждение
-            warning = f"⚠️ @{user.username or user.first_name}, сообщение удалено за нарушение правил."
-            await send_html_with_logging(
-                context.bot,
-                chat_id,
-                warning,
-                reply_markup=get_back_button()
-            )
+        # Предупреждение — в фоне: лимит группы (20 в минуту) не должен держать очередь чата
+        queue_moderation_warning(bot, chat_id, user.username or user.first_name)
 
-            logging.info(f"Модерация: удалено сообщение {msg.message_id} от {user.id} в чате {chat_id}")
+        logging.info(f"Модерация: удалено сообщение {msg.message_id} от {user.id} в чате {chat_id} ({violation!r})")
+
+    except Exception as e:
+        logging.error(f"Ошибка при модерации сообщения {msg.message_id} от {user.id}: {e}")
+
+
+# Предупреждения о модерации. Пока предупреждение ждёт отправки, новые нарушители
+# того же чата дописываются в него же; если лимит группы уже выбран, предупреждение
+# пропускаем — удаление важнее, а очередь чата не должна ждать.
+WARNING_MERGE_DELAY = 2.0   # секунд копим нарушителей одного чата
+WARNING_MAX_NAMES = 10      # сколько имён перечисляем в одном предупреждении
+_pending_warnings = {}      # chat_id -> имена нарушителей для ближайшего предупреждения
+
+
+def queue_moderation_warning(bot, chat_id, name):
+    names = _pending_warnings.get(chat_id)
+    if names is not None:
+        if name not in names and len(names) < WARNING_MAX_NAMES:
+            names.append(name)
+        metrics.MODERATION_WARNINGS.inc(result="merged")
+        return
+    _pending_warnings[chat_id] = [name]
+    run_in_background(send_moderation_warning(bot, chat_id), name=f"warning:{chat_id}")
+
+
+async def send_moderation_warning(bot, chat_id):
+    try:
+        await asyncio.sleep(WARNING_MERGE_DELAY)
+    finally:
+        names = _pending_warnings.pop(chat_id)
+
+    limiter = bot.rate_limiter
+    if isinstance(limiter, OutboundRateLimiter) and not limiter.has_capacity(chat_id):
+        metrics.MODERATION_WARNINGS.inc(result="dropped")
+        logging.info(f"Модерация: лимит чата {chat_id} выбран, предупреждение пропущено (нарушителей: {len(names)}).")
+        return
+
+    mentions = ", ".join(f"@{escape(name)}" for name in names)
+    if len(names) == 1:
+        warning = f"⚠️ {mentions}, сообщение удалено за нарушение правил."
+    else:
+        warning = f"⚠️ {mentions}: сообщения удалены за нарушение правил."
+    await send_html_with_logging(bot, chat_id, warning, reply_markup=get_back_button())
+    metrics.MODERATION_WARNINGS.inc(result="sent")
 
-        except Exception as e:
-            logging.error(f"Ошибка при модерации сообщения {msg.message_id} от {user.id}: {e}")
 
 # ---------- ПРИВЕТСТВИЕ В ГРУППЕ ----------
 
@@ -612,55 +1591,134 @@ async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
 # ---------- СТАТИСТИКА ----------
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_action(update, "stats")
     if update.effective_user.id not in ADMINS:
-        return await send_html(context.bot, update.effective_chat.id, "❌ Нет прав.")
+        return await send_html_with_logging(context.bot, update.effective_chat.id, "❌ Нет прав.")
     
     try:
-        async with aiosqlite.connect("users.db") as db:
-            # Выполняем оба запроса в рамках одной транзакции
-            async with db.begin():
-                cur = await db.execute("SELECT COUNT(*) FROM users")
-                users = (await cur.fetchone())[0]
-                cur = await db.execute("SELECT COUNT(*) FROM actions")
-                actions = (await cur.fetchone())[0]
-
-        # Отправляем статистику
-        await send_html(context.bot, update.effective_chat.id, f"👥 Пользователей: {users}\n⚙️ Действий: {actions}")
+        # Оба счётчика — одним запросом
+        users, actions = await db.get_stats()
+
+        # Отправляем статистику и сводку метрик процесса
+        await send_html_with_logging(
+            context.bot,
+            update.effective_chat.id,
+            f"👥 Пользователей: {users}\n⚙️ Действий: {actions}\n\n{escape(metrics.summary())}"
+        )
     
     except Exception as e:
         logging.error(f"Ошибка при получении статистики: {e}")
-        await send_html(context.bot, update.effective_chat.id, "❌ Ошибка при получении статистики. Попробуйте позже.")
+        await send_html_with_logging(context.bot, update.effective_chat.id, "❌ Ошибка при получении статистики. Попробуйте позже.")
 
 async def _search_dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.user_data.pop('in_search', False):
         # Если мы не в режиме поиска, пропускаем дальше
         return False  # PTB поймёт, что этот handler не был «отработан»
     # Иначе — реально обрабатываем
-    return await handle_search(update, context)
+    with metrics.HANDLER_SECONDS.time(handler="search_query"):
+        return await handle_search(update, context)
 
 # Обработчик кнопки "Назад"
 async def handle_back(update, context):
     try:
-        # Проверяем, существует ли сообщение и редактируем его
-        if update.callback_query.message:
-            logging.info("Editing message to return to main menu...")
-            # Редактируем сообщение, отправляя главное меню
-            await update.callback_query.message.edit_text(
-                "Вы вернулись в главное меню.",
-                reply_markup=get_main_menu()  # Главное меню
-            )
-        else:
-            logging.error("Message to edit not found.")
+        logging.info("Editing message to return to main menu...")
+        # Редактируем сообщение, отправляя главное меню
+        await show_screen(update, context, "Вы вернулись в главное меню.", reply_markup=get_main_menu())
     except Exception as e:
         logging.error(f"Ошибка при обработке кнопки 'Назад': {e}")
         await update.callback_query.answer("Ошибка при возвращении в главное меню. Попробуйте снова.")
 
+# ---------- ФЛУД-КОНТРОЛЬ ----------
+# Скользящее окно на пару (пользователь, действие) проверяется до запуска
+# хэндлера: лишнее нажатие получает всплывающий тост через answer(), без
+# похода в кэш, базу и без нового сообщения. Повторные нажатия той же кнопки,
+# пока первое ещё в очереди или в работе, отсекает ChatOrderedUpdateProcessor.
+DEFAULT_FLOOD_LIMIT = (5, 10.0)   # действий за секунд
+FLOOD_LIMITS = {
+    "random": (3, 5.0),
+    "arc": (20, 10.0),            # листать архив и поиск можно быстро
+    "srch": (20, 10.0),
+    "start": (3, 10.0),
+}
+FLOOD_SWEEP_INTERVAL = 60
+FLOOD_TOAST = "🐢 Не так быстро! Попробуйте через пару секунд."
+DUPLICATE_PRESS_TOAST = "⏳ Уже открываем…"
+
+
+class SlidingWindowLimiter:
+    # Не больше limit событий за window секунд на ключ
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.events = {}   # ключ -> deque меток времени
+
+    def allow(self, key, now):
+        events = self.events.get(key)
+        if events is None:
+            events = self.events[key] = deque()
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        if len(events) >= self.limit:
+            return False
+        events.append(now)
+        return True
+
+    def sweep(self, now):
+        # Ключи без событий в окне больше не нужны — словарь не растёт
+        stale = [key for key, events in self.events.items() if not events or events[-1] <= now - self.window]
+        for key in stale:
+            del self.events[key]
+
+
+_flood_limiters = {}   # действие -> SlidingWindowLimiter
+
+
+async def answer_toast(query, text):
+    # Дешёвый ответ на нажатие вместо работы хэндлера
+    try:
+        await query.answer(text)
+    except Exception as e:
+        logging.warning(f"Не удалось ответить на нажатие {query.data!r}: {e}")
+
+
+async def allow_action(update: Update, action: str) -> bool:
+    user = update.effective_user
+    if not user:
+        return True
+    limiter = _flood_limiters.get(action)
+    if limiter is None:
+        limiter = _flood_limiters[action] = SlidingWindowLimiter(*FLOOD_LIMITS.get(action, DEFAULT_FLOOD_LIMIT))
+    if limiter.allow(user.id, time.monotonic()):
+        return True
+    metrics.FLOOD_THROTTLED.inc(action=action)
+    if update.callback_query:
+        await answer_toast(update.callback_query, FLOOD_TOAST)
+    return False
+
+
+def flood_limited(action, callback):
+    # Флуд-контроль для команд и отдельных CallbackQueryHandler
+    async def wrapper(update, context):
+        if await allow_action(update, action):
+            return await callback(update, context)
+    return wrapper
+
+
+async def sweep_flood_limiters(context):
+    now = time.monotonic()
+    for limiter in _flood_limiters.values():
+        limiter.sweep(now)
+
+
 # Словарь обработчиков кнопок
 BUTTON_HANDLERS = {
     "about": show_about,
     "faq": show_faq,
     "latest": show_latest,
     "random": show_random,
+    "arc": show_archive,
+    "srch": show_search_page,
+    "sub": subscription_button,
     "platforms": show_platforms,
     "suggest": show_suggest,
     "guest": show_guest,
@@ -668,29 +1726,43 @@ BUTTON_HANDLERS = {
     "back": handle_back,  
 }
 
+def button_action(data):
+    return (data or "").split(":", 1)[0]
+
+
 # Обработчик кнопок
 async def handle_buttons(update, context):
+    # Неизвестные callback_data сводим в одну метку, чтобы не раздувать метрики;
+    # у листалок ("arc:3", "srch:<id>:3") метка — префикс до двоеточия
+    data = button_action(update.callback_query.data)
+    name = data if data in BUTTON_HANDLERS else "unknown"
+    if not await allow_action(update, name):
+        return
+    with metrics.HANDLER_SECONDS.time(handler=f"button:{name}"):
+        await _handle_button(update, context)
+
+
+async def _handle_button(update, context):
     query = update.callback_query
     await query.answer()
 
     # Логируем данные callback
     logging.info(f"Received callback query: {query.data}")
+    action = button_action(query.data)
+    log_action(update, action)
     
     # Обрабатываем кнопку "Назад"
     if query.data == "back":
         try:
             logging.info("Returning to main menu...")
             # Отправляем главное меню при нажатии на кнопку "Назад"
-            await update.callback_query.message.edit_text(
-                "Вы вернулись в главное меню.",
-                reply_markup=get_main_menu()  # Главное меню
-            )
+            await show_screen(update, context, "Вы вернулись в главное меню.", reply_markup=get_main_menu())
         except Exception as e:
             logging.error(f"Ошибка при обработке кнопки 'Назад': {e}")
             await query.answer("Ошибка при возвращении в главное меню. Попробуйте снова.")
     else:
         # Если это не кнопка "Назад", вызываем соответствующий обработчик
-        handler = BUTTON_HANDLERS.get(query.data)
+        handler = BUTTON_HANDLERS.get(action)
         if handler:
             try:
                 await handler(update, context)
@@ -704,96 +1776,402 @@ async def handle_buttons(update, context):
 
 
 
-# ---------- АВТОПОСТИНГ + РАССЫЛКА ----------
-# Инициализация записи в settings
-async def init_settings():
-    async with aiosqlite.connect("bot.db") as db:
-        cur = await db.execute("SELECT value FROM settings WHERE key='last_posted_url'")
-        if not await cur.fetchone():
-            await db.execute(
-                "INSERT INTO settings (key, value) VALUES ('last_posted_url', '')"
-            )
-            await db.commit()
-            logging.info("Записана начальная настройка в таблицу settings.")
-
-# Проверка нового эпизода
-async def check_new_episode():
-    eps = await fetch_episodes_from_rss()
-    async with aiosqlite.connect("bot.db") as db:
-        cur = await db.execute("SELECT value FROM settings WHERE key='last_posted_url'")
-        row = await cur.fetchone()
-        last_url = row[0] if row else None
-        new_ep = eps[-1] if eps else None
-
-        if new_ep and new_ep[1] != last_url:
-            await db.execute(
-                "REPLACE INTO settings (key, value) VALUES ('last_posted_url', ?)",
-                (new_ep[1],)
+# ---------- РАССЫЛКА ----------
+# Telegram пропускает ~30 сообщений в секунду на бота; держим запас.
+BROADCAST_RATE = 25           # сообщений в секунду
+BROADCAST_CONCURRENCY = 20    # одновременных запросов к Bot API
+
+
+class TokenBucket:
+    # Ограничитель скорости: не больше rate запросов в секунду, всплеск до capacity
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = asyncio.get_running_loop().time()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def idle(self):
+        # Ведро снова полное — им давно не пользовались
+        now = asyncio.get_running_loop().time()
+        return now >= self._paused_until and self._tokens + (now - self._updated) * self.rate >= self.capacity
+
+    def available(self):
+        # Есть ли токен прямо сейчас; ничего не списывает
+        now = asyncio.get_running_loop().time()
+        return now >= self._paused_until and self._tokens + (now - self._updated) * self.rate >= 1
+
+    def pause(self, seconds):
+        # После RetryAfter останавливаем всех отправителей, а не одного
+        loop_time = asyncio.get_running_loop().time()
+        self._paused_until = max(self._paused_until, loop_time + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    # В новых версиях PTB retry_after может быть timedelta
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+async def send_with_retries(bot, bucket, chat_id, text, reply_markup=None, started=None):
+    # Возвращает "sent", "blocked" или "failed". Сетевые ошибки и короткий
+    # флуд-контроль повторяет OutboundRateLimiter; здесь — только RetryAfter,
+    # который пережил его повторы: ждём и шлём снова, сообщение не теряем.
+    # В started попадают получатели, запрос которым уже ушёл в Telegram
+    while True:
+        await bucket.acquire()
+        if started is not None:
+            started.add(chat_id)
+        try:
+            await bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                parse_mode="HTML",
+                reply_markup=reply_markup,
+                disable_web_page_preview=True
             )
-            await db.commit()
-            return True
-    return False
+            return "sent"
+        except RetryAfter as e:
+            # Флуд-контроль: ждём сколько сказал Telegram, попытку не считаем
+            logging.warning(f"Рассылка: флуд-контроль, пауза {e.retry_after} с")
+            bucket.pause(retry_after_seconds(e))
+        except Forbidden as e:
+            logging.info(f"Рассылка: пользователь {chat_id} недоступен: {e}")
+            return "blocked"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "blocked"
+            logging.error(f"Рассылка: ошибка запроса для {chat_id}: {e}")
+            return "failed"
+        except (TimedOut, NetworkError) as e:
+            logging.error(f"Рассылка: не удалось отправить {chat_id}: {e}")
+            return "failed"
+        except Exception as e:
+            logging.error(f"Рассылка: ошибка при отправке {chat_id}: {e}")
+            return "failed"
+
+
+async def broadcast_batch(bot, bucket, chat_ids, text, results=None, started=None):
+    # Параллельно отправляет пачку сообщений. Возвращает {chat_id: результат};
+    # если рассылку отменили, в results и started остаётся то, что успели
+    queue = asyncio.Queue()
+    for chat_id in chat_ids:
+        queue.put_nowait(chat_id)
+    results = {} if results is None else results
 
-# Публикация нового эпизода
-async def post_new_episode_to_channel_and_subs(context):
+    async def worker():
+        while True:
+            try:
+                chat_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            # Кнопка «Назад» нужна только в личке, в канале она бесполезна
+            reply_markup = get_back_button() if isinstance(chat_id, int) and chat_id > 0 else None
+            results[chat_id] = await send_with_retries(bot, bucket, chat_id, text, reply_markup, started)
+
+    workers = min(BROADCAST_CONCURRENCY, queue.qsize())
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return results
+
+
+# ---------- ЗАДАНИЯ РАССЫЛКИ ----------
+# Каждая рассылка — строка в broadcast_jobs и по строке на получателя в
+# broadcast_deliveries. Отправитель идёт по получателям пачками и после каждой
+# пачки фиксирует статусы, поэтому после рестарта рассылка продолжается с того
+# же места. Перед отправкой пачка помечается 'sending': если процесс упал
+# посреди пачки, эти получатели получают статус 'unknown' и повторно не шлются.
+# При штатной остановке бота рассылку отменяет on_stop: отправленное
+# фиксируется, неначатые получатели возвращаются в 'pending'. Задание, упавшее
+# с ошибкой, остаётся 'running' и подхватывается следующим тиком планировщика.
+BROADCAST_BATCH_SIZE = 200
+
+_running_jobs = set()
+_resume_lock = asyncio.Lock()
+
+
+async def run_broadcast_job(bot, job_id):
+    if job_id in _running_jobs:
+        return
+    _running_jobs.add(job_id)
     try:
-        # 1) Проверяем, есть ли новый эпизод
-        if not await check_new_episode():
-            logging.info("Новый выпуск не найден.")
+        text = await db.get_broadcast_text(job_id)
+        if text is None:
+            logging.error(f"Задание рассылки #{job_id} не найдено.")
             return
 
-        # 2) Если есть — берём последний эпизод и публикуем
-        eps = await fetch_episodes_from_rss()
-        title, url, description = eps[-1]
-        desc = clean_html(description)  # если вы хотите добавить описание
-        text = (
-            f"🎙 <b>Новый выпуск:</b>\n\n"
-            f"🔹 <a href=\"{url}\">{title}</a>\n"
+        bucket = TokenBucket(BROADCAST_RATE)
+        stats = {"sent": 0, "blocked": 0, "failed": 0}
+        started = asyncio.get_running_loop().time()
+
+        # Keyset-пагинация: в памяти только одна пачка получателей
+        async for chat_ids in db.iter_pending_deliveries(job_id, BROADCAST_BATCH_SIZE):
+            results, in_flight = {}, set()
+            try:
+                await broadcast_batch(bot, bucket, chat_ids, text, results, in_flight)
+            except asyncio.CancelledError:
+                # Остановка бота: начатые запросы — 'unknown', остальные ждут рестарта
+                unsent = [uid for uid in chat_ids if uid not in results]
+                results.update({uid: "unknown" if uid in in_flight else "pending" for uid in unsent})
+                await checkpoint_batch(job_id, results, stats)
+                logging.info(
+                    f"Рассылка #{job_id} прервана остановкой бота, "
+                    f"в очереди осталось получателей пачки: {len(unsent)}."
+                )
+                raise
+
+            # Чекпоинт после каждой пачки
+            await checkpoint_batch(job_id, results, stats)
+
+        await db.finish_broadcast_job(job_id)
+
+        elapsed = asyncio.get_running_loop().time() - started
+        total = stats["sent"] + stats["blocked"] + stats["failed"]
+        metrics.BROADCAST_RATE.set(round(stats["sent"] / elapsed, 1) if elapsed else 0)
+        logging.info(
+            f"Рассылка #{job_id} завершена: отправлено {stats['sent']}, недоступны {stats['blocked']}, "
+            f"ошибок {stats['failed']} из {total} за {elapsed:.1f} с "
+            f"({stats['sent'] / elapsed if elapsed else 0:.1f} сообщ./с)"
         )
-        if desc:
-            text += f"\n<i>{desc}</i>"
-
-        # 2a) Публикация в канал
-        await send_html_with_logging(context.bot, PODCAST_channel_id, text, disable_web_page_preview=True)
-
-        # Рассылка подписчикам
-        async with aiosqlite.connect("bot.db") as db:  # <-- тут тоже bot.db
-            cur = await db.execute("SELECT user_id FROM subscriptions")
-            subs = await cur.fetchall()
-        for (uid,) in subs:
-            await send_html_with_logging(
-                context.bot, uid, text,
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back")]])
-            )
+        return stats
+    except Exception as e:
+        logging.error(f"Ошибка при выполнении рассылки #{job_id}: {e}")
+    finally:
+        _running_jobs.discard(job_id)
+
+
+async def checkpoint_batch(job_id, results, stats):
+    await db.checkpoint_deliveries(job_id, results)
+    for result in results.values():
+        if result in stats:
+            stats[result] += 1
+            metrics.BROADCAST_MESSAGES.inc(result=result)
+    await db.deactivate_subscribers([uid for uid, result in results.items() if result == "blocked"])
+
+
+async def resume_broadcast_jobs(context):
+    # Дорабатываем рассылки, прерванные рестартом или ошибкой посреди отправки.
+    # Зовётся при старте и на каждом тике планировщика
+    if _resume_lock.locked():
+        return
+    try:
+        job_ids = await db.unfinished_broadcast_jobs(exclude=_running_jobs)
+    except Exception as e:
+        logging.error(f"Ошибка при поиске незавершённых рассылок: {e}")
+        return
+
+    # В фоне: джоба не держит планировщик, а on_stop может отменить рассылку
+    if job_ids:
+        run_in_background(resume_jobs(context.bot, job_ids), name="resume_broadcasts")
+
 
-        logging.info("Новый выпуск был опубликован.")
+async def resume_jobs(bot, job_ids):
+    async with _resume_lock:
+        for job_id in job_ids:
+            if job_id in _running_jobs:
+                continue
+            logging.info(f"Продолжаем незавершённую рассылку #{job_id}.")
+            await run_broadcast_job(bot, job_id)
+
+
+# ---------- АВТОПОСТИНГ + РАССЫЛКА ----------
+# Новые выпуски ищутся по guid: всё, чего нет в seen_episodes, публикуется
+# по порядку дат. Guid отмечается виденным вместе с созданием задания
+# рассылки (см. create_broadcast_job), так что выпуск не теряется и не дублируется.
+NEW_EPISODES_LIMIT = 5  # больше за один опрос — скорее всего, лента сменила guid
+
+async def backfill_seen_episodes(feed, eps):
+    # Первый запуск ленты: всё, что уже лежит в RSS, публиковать не нужно.
+    # После версии с last_posted_url публикуем только то, что вышло после него
+    last_url = await db.get_last_posted_url(feed.id)
+    urls = [ep.url for ep in eps]
+    seen = eps[:urls.index(last_url) + 1] if last_url in urls else eps
+    guids = {ep.guid for ep in seen}
+    await db.mark_episodes_seen(feed.id, guids, backfill=True)
+    logging.info(f"Лента {feed.slug}: отмечено виденными выпусков при первом запуске: {len(guids)}.")
+    return guids
+
+
+async def find_unseen_episodes(feed):
+    # Невиденные выпуски ленты, от старых к новым
+    eps = await get_episodes(feed)
+    if not eps:
+        return []
+    if feed.seen_guids is None:
+        feed.seen_guids = await db.load_seen_guids(feed.id)
+        if feed.seen_guids is None:
+            feed.seen_guids = await backfill_seen_episodes(feed, eps)
+
+    unseen = [ep for ep in eps if ep.guid not in feed.seen_guids]
+    if len(unseen) > NEW_EPISODES_LIMIT:
+        skipped = unseen[:-NEW_EPISODES_LIMIT]
+        logging.warning(
+            f"Лента {feed.slug}: {len(unseen)} новых выпусков за раз, "
+            f"публикуем последние {NEW_EPISODES_LIMIT}, остальные пропускаем."
+        )
+        await db.mark_episodes_seen(feed.id, [ep.guid for ep in skipped])
+        feed.seen_guids.update(ep.guid for ep in skipped)
+        unseen = unseen[-NEW_EPISODES_LIMIT:]
+    return unseen
+
+# Публикация новых выпусков одной ленты: в её канал и её подписчикам
+async def post_new_episodes(bot, feed):
+    try:
+        # 1) Ищем все невиденные выпуски
+        new_eps = await find_unseen_episodes(feed)
+        if not new_eps:
+            logging.info(f"Новых выпусков ленты {feed.slug} не найдено.")
+            return
+
+        # 2) Публикуем их по порядку (тексты постов уже собраны в кэше)
+        for ep in new_eps:
+            text = get_rendered(ep, feed).post_text
+
+            # Публикация в канал и рассылка подписчикам — одно задание,
+            # которое переживёт рестарт посреди отправки
+            chat_ids = [feed.channel_id] if feed.channel_id else []
+            job_id = await db.create_broadcast_job(feed.id, text, guid=ep.guid, chat_ids=chat_ids)
+            feed.seen_guids.add(ep.guid)
+            logging.info(f"Создано задание рассылки #{job_id} для ленты {feed.slug}: {ep.title}")
+            await run_broadcast_job(bot, job_id)
+
+        logging.info(f"Новых выпусков ленты {feed.slug} опубликовано: {len(new_eps)}.")
     except Exception as e:
-        logging.error(f"Ошибка при публикации нового эпизода: {e}")
+        logging.error(f"Ошибка при публикации новых выпусков ленты {feed.slug}: {e}")
+        feed.check_pending = True  # повторим на следующем опросе ленты
+
+
+# ---------- ПЛАНИРОВЩИК ОПРОСА ЛЕНТ ----------
+# Вместо опроса по часам и автопостинга по расписанию — один тикер.
+# Каждую минуту он опрашивает ленты, у которых подошёл срок, и в том же тике
+# публикует найденный выпуск. Срок считается по расписанию выпусков,
+# выученному из дат публикации: рядом с ожидаемым временем выхода лента
+# опрашивается раз в пару минут, в остальное время интервал удваивается
+# до часа. Cache-Control/Expires сервера тоже соблюдаются.
+SCHEDULER_TICK = 60            # секунд между проверками сроков
+POLL_FAST = 120                # интервал в окне ожидаемого выпуска
+POLL_MIN_IDLE = 600            # вне окна — от 10 минут…
+POLL_MAX_IDLE = 3600           # …до часа, если лента не меняется
+RELEASE_HISTORY = 20           # по скольким последним выпускам учим расписание
+RELEASE_WINDOW_BEFORE = 1      # часов до обычного времени выхода
+RELEASE_WINDOW_AFTER = 4       # и после него (выпуски иногда опаздывают)
+HOURS_IN_WEEK = 7 * 24
+
+_post_lock = asyncio.Lock()
+_scheduler_lock = asyncio.Lock()  # тики не накладываются друг на друга
+
+
+def learn_release_slots(episodes):
+    # Часы недели (0..167, UTC), в которые выходили последние выпуски
+    dates = sorted((ep.published for ep in episodes if ep.published), reverse=True)[:RELEASE_HISTORY]
+    return {d.weekday() * 24 + d.hour for d in dates}
+
+
+def in_release_window(slots, now):
+    hour = now.weekday() * 24 + now.hour
+    return any(
+        (hour - slot) % HOURS_IN_WEEK <= RELEASE_WINDOW_AFTER
+        or (slot - hour) % HOURS_IN_WEEK <= RELEASE_WINDOW_BEFORE
+        for slot in slots
+    )
+
+
+def schedule_next_poll(feed, changed):
+    # Интервал до следующего опроса ленты после очередного запроса
+    if changed:
+        feed.idle_interval = POLL_MIN_IDLE
+    if in_release_window(learn_release_slots(feed.episodes), datetime.utcnow()):
+        interval = POLL_FAST
+    else:
+        interval = feed.idle_interval
+        feed.idle_interval = min(feed.idle_interval * 2, POLL_MAX_IDLE)
+    # Раньше срока свежести сервер всё равно ответит тем же
+    if feed.freshness:
+        interval = max(interval, min(feed.freshness, POLL_MAX_IDLE))
+    feed.next_poll_at = asyncio.get_running_loop().time() + interval
+    metrics.FEED_POLL_INTERVAL.set(interval, feed=feed.slug)
+    return interval
+
+
+async def post_new_episodes_locked(bot, feed):
+    # Рассылки разных лент идут по очереди: лимит Telegram общий на бота.
+    # Поиск новых выпусков и создание заданий — под тем же замком, так что дублей не будет
+    async with _post_lock:
+        await post_new_episodes(bot, feed)
+
+
+async def poll_and_post(bot, feed):
+    changed = await poll_feed(feed)
+    interval = schedule_next_poll(feed, changed)
+    logging.info(f"Лента {feed.slug}: следующий опрос через {interval:.0f} с.")
+    if changed or feed.check_pending:
+        feed.check_pending = False
+        # Публикуем в фоне, чтобы длинная рассылка не задерживала опрос других лент
+        run_in_background(post_new_episodes_locked(bot, feed), name=f"post:{feed.slug}")
+
+
+async def run_feed_scheduler(context):
+    if _scheduler_lock.locked():
+        return
+    async with _scheduler_lock:
+        await _run_feed_scheduler_tick(context)
+
+
+async def _run_feed_scheduler_tick(context):
+    await load_feed_registry()
+    now = asyncio.get_running_loop().time()
+    due = [feed for feed in FEEDS.values() if feed.next_poll_at <= now]
+    results = await asyncio.gather(*(poll_and_post(context.bot, feed) for feed in due), return_exceptions=True)
+    for feed, result in zip(due, results):
+        if isinstance(result, Exception):
+            logging.error(f"Ошибка планировщика для ленты {feed.slug}: {result}")
+    # Рассылки, упавшие посреди отправки, не ждут рестарта
+    await resume_broadcast_jobs(context)
 
 
 async def forcepost_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_action(update, "forcepost")
     if update.effective_user.id not in ADMINS:
         await update.message.reply_text("⛔ У вас нет доступа к этой команде.")
         return
 
-    episodes = await fetch_episodes_from_rss()
+    # /forcepost [лента] — по умолчанию основная лента
+    slug = context.args[0] if context.args else None
+    feed = get_feed(slug)
+    if feed is None:
+        await update.message.reply_text(f"❗ Лента {slug} не найдена. Доступны: {', '.join(FEEDS)}")
+        return
+    if not feed.channel_id:
+        await update.message.reply_text(f"❗ У ленты {feed.slug} не указан канал.")
+        return
+
+    episodes = await get_episodes(feed)
     if not episodes:
         await update.message.reply_text("❗ Эпизоды не найдены.")
         return
 
-    title, url, description = episodes[-1]
-    desc = clean_html(description)
-
-    text = (
-        f"🎙 <b>Новый выпуск:</b>\n\n"
-        f"🔹 <a href=\"{url}\">{title}</a>\n"
-    )
-    if desc:
-        text += f"\n<i>{desc}</i>"
+    title = episodes[-1].title
+    text = get_rendered(episodes[-1], feed).post_text
 
     try:
-        logging.info(f"⏩ Публикуем новый выпуск в канал: {title}")  
-        await send_html_with_logging(context.bot, PODCAST_channel_id, text, disable_web_page_preview=True)
+        logging.info(f"⏩ Публикуем новый выпуск ленты {feed.slug} в канал: {title}")
+        await send_html_with_logging(context.bot, feed.channel_id, text, disable_web_page_preview=True)
         
         await update.message.reply_text("✅ Выпуск опубликован вручную.")
         logging.info("✅ Ручная публикация выполнена.")
@@ -816,52 +2194,400 @@ async def handle_error(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.error(f"Ошибка: {context.error}")
   
     
+# ---------- ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ ----------
+# Апдейты разных чатов обрабатываются параллельно, апдейты одного чата —
+# строго по очереди (на этом держится флаг in_search в user_data).
+# Групповым чатам достаётся не больше половины обработчиков, а очередь
+# одной группы ограничена, так что флуд в группе не отнимает ответы в личке.
+GROUP_WORKERS_SHARE = 0.5
+GROUP_BACKLOG_LIMIT = 50     # апдейтов в очереди одной группы, дальше — отбрасываем
+UPDATE_BACKLOG_LIMIT = 1000  # всего апдейтов в работе и в очереди
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # max_concurrent_updates базового класса — общий предел очереди,
+    # а реальную параллельность задаёт workers
+    def __init__(self, workers):
+        super().__init__(max_concurrent_updates=UPDATE_BACKLOG_LIMIT)
+        self.workers = workers
+        self.active = 0
+        self._worker_slots = asyncio.Semaphore(workers)
+        self._group_slots = asyncio.Semaphore(max(1, int(workers * GROUP_WORKERS_SHARE)))
+        self._chat_locks = {}
+        self._pending = defaultdict(int)
+        self._presses = set()    # (пользователь, callback_data) в очереди или в работе
+
+    @staticmethod
+    def ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id, update.effective_chat.type
+            if update.effective_user:
+                return update.effective_user.id, ChatType.PRIVATE
+        return None, None
+
+    @staticmethod
+    def press_key(update):
+        # Нажатие кнопки: (пользователь, callback_data); для прочих апдейтов None
+        if isinstance(update, Update) and update.callback_query and update.effective_user:
+            return update.effective_user.id, update.callback_query.data
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key, chat_type = self.ordering_key(update)
+        if key is None:
+            async with self._worker_slots:
+                await self._run(coroutine)
+            return
+
+        is_group = chat_type != ChatType.PRIVATE
+        if is_group and self._pending[key] >= GROUP_BACKLOG_LIMIT:
+            coroutine.close()
+            forget_update(update)
+            metrics.UPDATES_DROPPED.inc(reason="backlog")
+            logging.warning(f"Чат {key} перегружен: апдейт отброшен (в очереди {self._pending[key]}).")
+            # Меню и поиск при флуде можно потерять, спам — нет: нарушение
+            # удаляем мимо очереди чата
+            if MODERATED_MESSAGES.check_update(update):
+                msg = update.effective_message
+                violation = moderation_violation(msg)
+                if violation:
+                    run_in_background(
+                        moderate_message(update.get_bot(), msg, violation),
+                        name=f"moderate:{key}",
+                    )
+            return
+
+        # Двойной тап по кнопке: первое нажатие ещё не обработано — второе не выполняем
+        press = self.press_key(update)
+        if press is not None:
+            if press in self._presses:
+                coroutine.close()
+                forget_update(update)
+                metrics.UPDATES_DROPPED.inc(reason="duplicate")
+                await answer_toast(update.callback_query, DUPLICATE_PRESS_TOAST)
+                return
+            self._presses.add(press)
+
+        self._pending[key] += 1
+        lock = self._chat_locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                if is_group:
+                    async with self._group_slots, self._worker_slots:
+                        await self._run(coroutine)
+                else:
+                    async with self._worker_slots:
+                        await self._run(coroutine)
+        finally:
+            self._presses.discard(press)
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                # Никто больше не ждёт — чистим, чтобы словари не росли
+                del self._pending[key]
+                self._chat_locks.pop(key, None)
+
+    async def _run(self, coroutine):
+        self.active += 1
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# ---------- WEBHOOK ----------
+# Встроенный aiohttp-сервер: принимает апдейты от Telegram (или от reverse proxy),
+# проверяет секретный токен и кладёт апдейты в очередь Application.
+# /health отдаёт состояние очереди и задержку обработки апдейтов.
+LATENCY_WINDOW = 1000  # по скольким последним апдейтам считаем задержку
+
+_update_received = {}
+_update_latencies = deque(maxlen=LATENCY_WINDOW)
+_metrics_runner = None
+_first_response_logged = False
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def record_update_latency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Хэндлер последней группы: апдейт прошёл все остальные хэндлеры
+    global _first_response_logged
+    received = _update_received.pop(update.update_id, None)
+    if received is not None:
+        latency = asyncio.get_running_loop().time() - received
+        _update_latencies.append(latency)
+        metrics.UPDATE_SECONDS.observe(latency)
+    if not _first_response_logged:
+        _first_response_logged = True
+        log_startup_stage("first_response", "Первый апдейт после рестарта обработан")
+
+
+def forget_update(update):
+    # Апдейт отброшен до хэндлеров: в задержку не попадает, но и в in_flight не висит
+    _update_received.pop(update.update_id, None)
+
+
+def log_startup_stage(stage, message):
+    # Время от запуска процесса до этапа старта — в лог и в метрики
+    elapsed = time.monotonic() - STARTED_AT
+    metrics.STARTUP_SECONDS.set(round(elapsed, 3), stage=stage)
+    logging.info(f"{message} через {elapsed:.2f} с после запуска.")
+
+
+def stop_signal():
+    # Событие, которое выставляется по SIGINT/SIGTERM
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
+
+
+def add_metrics_route(server, web):
+    # /metrics в текстовом формате Prometheus
+    async def metrics_page(request):
+        return web.Response(
+            text=metrics.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    server.router.add_get("/metrics", metrics_page)
+
+
+async def start_metrics_server():
+    # В режиме polling webhook-сервера нет — /metrics поднимаем отдельно
+    global _metrics_runner
+    try:
+        from aiohttp import web
+    except ImportError:
+        logging.error("Для /metrics нужен aiohttp: pip install aiohttp")
+        return
+
+    server = web.Application()
+    add_metrics_route(server, web)
+    _metrics_runner = web.AppRunner(server, access_log=None)
+    await _metrics_runner.setup()
+    await web.TCPSite(_metrics_runner, METRICS_LISTEN, METRICS_PORT).start()
+    logging.info(f"Метрики доступны на {METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+
+async def run_webhook(app):
+    try:
+        from aiohttp import web
+    except ImportError:
+        raise RuntimeError("Для режима webhook нужен aiohttp: pip install aiohttp")
+
+    # Без секрета любой POST на публичный путь сошёл бы за апдейт от Telegram,
+    # в том числе с чужим from.id и админскими командами. Если вебхук
+    # регистрируем сами — секрет можно сгенерировать, иначе не стартуем
+    secret = WEBHOOK_SECRET
+    if not secret:
+        if not WEBHOOK_URL:
+            raise RuntimeError("Для режима webhook нужен WEBHOOK_SECRET (или WEBHOOK_URL, чтобы сгенерировать его)")
+        secret = secrets.token_urlsafe(32)
+        logging.info("WEBHOOK_SECRET не задан: сгенерирован случайный секрет для setWebhook.")
+
+    async def telegram_webhook(request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, secret):
+            logging.warning(f"Webhook: неверный секретный токен от {request.remote}")
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), app.bot)
+        except Exception as e:
+            logging.error(f"Webhook: не удалось разобрать апдейт: {e}")
+            return web.Response(status=400)
+
+        _update_received[update.update_id] = asyncio.get_running_loop().time()
+        await app.update_queue.put(update)
+        # Отвечаем сразу: обработка идёт в Application, Telegram ждать не должен
+        return web.Response()
+
+    async def health(request):
+        latencies = list(_update_latencies)
+        return web.json_response({
+            "status": "ok" if app.running else "stopping",
+            "update_queue": app.update_queue.qsize(),
+            "in_flight": len(_update_received),
+            "workers": app.update_processor.workers,
+            "processing": app.update_processor.active,
+            "latency_ms": {
+                "p50": round(percentile(latencies, 0.5) * 1000, 1),
+                "p99": round(percentile(latencies, 0.99) * 1000, 1),
+                "samples": len(latencies),
+            },
+        })
+
+    server = web.Application()
+    server.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    server.router.add_get("/health", health)
+    add_metrics_route(server, web)
+    runner = web.AppRunner(server, access_log=None)
+    stop = stop_signal()
+
+    async with app:
+        await app.start()
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=secret,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        logging.info(f"Webhook-сервер слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        log_startup_stage("ready", "Бот принимает апдейты")
+        try:
+            await stop.wait()
+        finally:
+            await runner.cleanup()
+            await app.stop()
+            # Жизненным циклом управляем сами, поэтому post_stop и post_shutdown зовём сами
+            if app.post_stop:
+                await app.post_stop(app)
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+
+# ---------- POLLING ----------
+# Тот же жизненный цикл, что и у webhook, но апдейты забирает Updater.
+# Application.run_polling не используем: он сам управляет event loop и не
+# работает внутри asyncio.run.
+async def run_polling(app):
+    if METRICS_PORT:
+        await start_metrics_server()
+    stop = stop_signal()
+
+    async with app:
+        await app.start()
+        # chat_member нужно запросить явно, иначе Telegram его не присылает
+        await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        log_startup_stage("ready", "Бот принимает апдейты")
+        try:
+            await stop.wait()
+        finally:
+            await app.updater.stop()
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+
 # ---------- ТОЧКА ВХОДА ----------
+async def on_stop(app):
+    # Бот и база ещё открыты: прерванная рассылка успеет записать чекпоинт
+    await cancel_background_tasks()
+
+
+async def on_shutdown(app):
+    # Закрываем долгоживущие соединения
+    if _http_client is not None:
+        await _http_client.aclose()
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+    await db.drain_pending_writes()
+    await db.close()
+
+async def prepare_storage():
+    # База, правила модерации и реестр лент — всё локальное, без сети
+    await db.connect()  # Долгоживущие соединения с bot.db
+    await db.init_db()  # Таблицы и начальные настройки
+    await db.seed_moderation_rules(default_rules())
+    await reload_moderation_rules()
+    await db.seed_feeds(FEEDS_CONFIG)
+    await load_feed_registry()
+    if not FEEDS:
+        raise RuntimeError("В реестре нет ни одной ленты: проверьте RSS_FEED/FEEDS в config.py и таблицу feeds")
+    logging.info(f"Лент в реестре: {len(FEEDS)}.")
+
+
+def build_application():
+    # Application со всеми хэндлерами; bench/ собирает бота этой же функцией
+    app = (
+        ApplicationBuilder()
+        .token(PODCAST_BOT)
+        .base_url(TELEGRAM_API_URL)
+        # Запросы к Bot API идут через счётчики метрик и общую очередь исходящих
+        .request(build_request())
+        .rate_limiter(OutboundRateLimiter())
+        .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    # Регистрируем обработчики
+    app.add_handler(CommandHandler("start", timed("command:start", flood_limited("start", start))))
+    app.add_handler(CommandHandler("stats", timed("command:stats", stats_command)))
+    app.add_handler(CommandHandler("subscribe", timed("command:subscribe", flood_limited("subscribe", subscribe_command)), filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler("unsubscribe", timed("command:unsubscribe", flood_limited("unsubscribe", unsubscribe_command)), filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler("forcepost", timed("command:forcepost", forcepost_command)))
+    app.add_handler(CommandHandler("reloadrules", timed("command:reloadrules", reloadrules_command)))
+    app.add_handler(CallbackQueryHandler(timed("button:search", flood_limited("search", search_button)), pattern="^search$"))
+    app.add_handler(InlineQueryHandler(timed("inline_query", inline_query)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, _search_dispatcher), group=0)
+    # «Поиск» обрабатывается выше — здесь не считаем его второй раз и не шлём меню
+    app.add_handler(CallbackQueryHandler(handle_buttons, pattern="^(?!search$)"), group=1)
+    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_new_member))
+    app.add_handler(MessageHandler(MODERATED_MESSAGES, timed("moderation", moderate_messages)), group=2)
+    app.add_handler(ChatMemberHandler(track_chat_admins, ChatMemberHandler.ANY_CHAT_MEMBER), group=3)
+    app.add_handler(TypeHandler(Update, record_update_latency), group=99)
+    return app
+
+
+def schedule_jobs(job_queue):
+    # --- ДОРАБОТАТЬ ПРЕРВАННЫЕ РАССЫЛКИ ---
+    job_queue.run_once(resume_broadcast_jobs, when=0)
+    # --- ОПРОС ЛЕНТ И АВТОПОСТИНГ ---
+    # Первый тик — сразу: проверяет новые выпуски всех лент после рестарта
+    job_queue.run_once(run_feed_scheduler, when=0)
+    job_queue.run_repeating(run_feed_scheduler, interval=SCHEDULER_TICK, first=SCHEDULER_TICK)
+    # --- ДАЛЬНЕЙШИЕ ЗАДАЧИ ---
+    # Перечитывать правила модерации из базы
+    job_queue.run_repeating(reload_moderation_rules, interval=RULES_RELOAD_INTERVAL, first=RULES_RELOAD_INTERVAL)
+    # Сбрасывать буфер пользователей и действий в базу
+    job_queue.run_repeating(flush_pending_writes, interval=db.FLUSH_INTERVAL, first=db.FLUSH_INTERVAL)
+    # Чистить окна флуд-контроля от неактивных пользователей
+    job_queue.run_repeating(sweep_flood_limiters, interval=FLOOD_SWEEP_INTERVAL, first=FLOOD_SWEEP_INTERVAL)
+
+
 async def main():
     try:
         # Инициализируем таблицы и настройки при старте
-        await init_db()  # Инициализация базы данных
-        await init_settings()  # Инициализация настроек в таблице
+        await prepare_storage()
 
-        # Проверка нового эпизода перед запуском бота
-        eps = await fetch_episodes_from_rss()
-        logging.info(f"При старте RSS содержит {len(eps)} эпизодов, последний: {eps[-1][0]}")
-    
-        # Далее запускаем бота
-        app = ApplicationBuilder().token(PODCAST_BOT).build()
-        
-        # Регистрируем обработчики
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("stats", stats_command))
-        app.add_handler(CommandHandler("forcepost", forcepost_command))
-        app.add_handler(CallbackQueryHandler(search_button, pattern="^search$"))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, _search_dispatcher), group=0)
-        app.add_handler(CallbackQueryHandler(handle_buttons), group=1)
-        app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_new_member))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.StatusUpdate.NEW_CHAT_MEMBERS, moderate_messages), group=2)
-
-        # 1) запланировать отложенную публикацию _до_ обновления БД
-        job_queue = app.job_queue
-        # --- СРАЗУ ПУБЛИКОВАТЬ НОВЫЙ ЭПИЗОД ---
-        # Планируем на момент старта (when=0), чтобы он выполнился сразу.
-        job_queue.run_once(post_new_episode_to_channel_and_subs, when=0)
-        # --- ДАЛЬНЕЙШИЕ ЗАДАЧИ ---
-        # Обновлять кэш раз в час
-        job_queue.run_repeating(update_episode_cache, interval=3600, first=0)
-        # Автопостинг по будням
-        job_queue.run_daily(
-            post_new_episode_to_channel_and_subs,
-            time=time(hour=7, minute=0),
-            days=(1, 3, 5)
-        )
+        # Кэш эпизодов прогревается в фоне из базы: бот начинает отвечать
+        # сразу, а хэндлеры, пришедшие раньше, дождутся прогрева ленты
+        run_in_background(warm_up_feeds(), name="warm_up_feeds")
+
+        # Далее запускаем бота: обработчики и фоновые задачи
+        app = build_application()
+        schedule_jobs(app.job_queue)
 
         # Запуск бота
-        logging.info("Бот успешно запущен.")
-        await app.run_polling()
+        logging.info(f"Бот успешно запущен в режиме {BOT_MODE}.")
+        if BOT_MODE == "webhook":
+            await run_webhook(app)
+        else:
+            await run_polling(app)
 
     except RuntimeError as e:
-        if "Cannot close a running event loop" in str(e):
-            pass
         logging.error(f"Ошибка при запуске бота: {e}")
 
 # --- Запуск программы ---
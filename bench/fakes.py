@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import random
+import time
+from collections import Counter
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from html import escape
+
+from aiohttp import web
+
+# ——————————————————————————————————————————————————————————
+# Локальные заглушки api.telegram.org и RSS-хостинга для нагрузочных тестов.
+# Обе умеют задержку, случайные ошибки сервера, а Bot API — ещё и 429 с
+# retry_after и 403 для пользователей, заблокировавших бота.
+
+BOT_ID = 4242
+WORDS = (
+    "новости технологии роботы искусственный интеллект космос наука котики экономика "
+    "кино музыка игры смартфоны выборы климат медицина спорт образование стартапы "
+    "нейросети интернет безопасность путешествия история книги еда здоровье транспорт "
+    "энергетика политика культура мемы соцсети блогеры криптовалюта биология физика"
+).split()
+
+
+class Faults:
+    # Задержка и доля ошибок одного сервера
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    async def delay(self):
+        wait = self.latency + random.uniform(0, self.jitter)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def server_error(self):
+        return random.random() < self.error_rate
+
+
+def _error(code, description, **parameters):
+    payload = {"ok": False, "error_code": code, "description": description}
+    if parameters:
+        payload["parameters"] = parameters
+    return web.json_response(payload, status=code)
+
+
+# ---------- BOT API ----------
+class FakeTelegram:
+    def __init__(self, faults, flood_rate=0.0, retry_after=1):
+        self.faults = faults
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.blocked = set()          # chat_id, которые «заблокировали бота»
+        self.calls = Counter()
+        self.responses = Counter()   # (метод, код ответа)
+        self.sent_to = set()
+        self._message_id = 0
+
+    def _message(self, chat_id, text=""):
+        self._message_id += 1
+        chat_id = int(chat_id)
+        chat_type = "private" if chat_id > 0 else "supergroup"
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": chat_type},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "bench"},
+            "text": text,
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.calls[method] += 1
+        await self.faults.delay()
+
+        response = self._answer(method, data)
+        self.responses[method, response.status] += 1
+        return response
+
+    def _answer(self, method, data):
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": BOT_ID, "is_bot": True, "first_name": "bench", "username": "bench_bot"
+            }})
+        if self.faults.server_error():
+            return _error(502, "Bad Gateway")
+        if method in ("sendMessage", "editMessageText") and random.random() < self.flood_rate:
+            return _error(429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after)
+
+        chat_id = data.get("chat_id", 0)
+        if method == "sendMessage":
+            if int(chat_id) in self.blocked:
+                return _error(403, "Forbidden: bot was blocked by the user")
+            self.sent_to.add(int(chat_id))
+            return web.json_response({"ok": True, "result": self._message(chat_id, data.get("text", ""))})
+        if method == "editMessageText":
+            return web.json_response({"ok": True, "result": self._message(chat_id, data.get("text", ""))})
+        if method == "getChatAdministrators":
+            return web.json_response({"ok": True, "result": [{
+                "status": "creator", "is_anonymous": False,
+                "user": {"id": 1, "is_bot": False, "first_name": "admin"},
+            }]})
+        # answerCallbackQuery, deleteMessage, setWebhook и прочее
+        return web.json_response({"ok": True, "result": True})
+
+
+# ---------- RSS ----------
+class FakeRSS:
+    def __init__(self, faults, episodes=300, seed=0):
+        self.faults = faults
+        self.requests = Counter()    # код ответа -> количество
+        self.body = build_feed(episodes, seed)
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest() + '"'
+
+    async def handle(self, request):
+        await self.faults.delay()
+        if self.faults.server_error():
+            self.requests[503] += 1
+            return web.Response(status=503)
+        if request.headers.get("If-None-Match") == self.etag:
+            self.requests[304] += 1
+            return web.Response(status=304)
+        self.requests[200] += 1
+        return web.Response(
+            body=self.body,
+            content_type="application/rss+xml",
+            headers={"ETag": self.etag, "Cache-Control": "max-age=300"},
+        )
+
+
+def build_feed(count, seed=0):
+    # Лента как у подкаст-хостинга: свежие выпуски первыми, HTML в описаниях
+    rng = random.Random(seed)
+    newest = datetime(2026, 1, 5, 7, 0, tzinfo=timezone.utc)
+    items = []
+    for number in range(count, 0, -1):
+        title = " ".join(rng.sample(WORDS, 4)).capitalize()
+        paragraphs = "".join(
+            f"<p>{escape(' '.join(rng.choices(WORDS, k=40)))}</p>" for _ in range(3)
+        )
+        published = newest - timedelta(weeks=(count - number) / 3)
+        items.append(
+            f"<item><title>{escape(title)}</title>"
+            f"<link>https://podcast.example/episodes/{number}</link>"
+            f"<guid>episode-{number}</guid>"
+            f"<description>{escape(paragraphs)}</description>"
+            f"<pubDate>{format_datetime(published)}</pubDate></item>"
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+        "<title>Bench podcast</title>" + "".join(items) + "</channel></rss>"
+    ).encode("utf-8")
+
+
+async def start_servers(telegram, rss, host="127.0.0.1", port=0):
+    # Один aiohttp-сервер на обе заглушки; возвращает (runner, базовый URL)
+    app = web.Application(client_max_size=4 * 1024 * 1024)
+    app.router.add_post("/bot{token}/{method}", telegram.handle)
+    app.router.add_get("/rss.xml", rss.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    bound_port = runner.addresses[0][1]
+    return runner, f"http://{host}:{bound_port}"
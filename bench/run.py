@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import types
+
+from bench.fakes import FakeRSS, FakeTelegram, Faults, start_servers
+from bench.scenarios import UPDATE_SCENARIOS, UpdateTracker, broadcast
+
+# ——————————————————————————————————————————————————————————
+# Нагрузочный стенд: поднимает заглушки Bot API и RSS, собирает настоящего
+# бота (build_application) на временной базе и гоняет сценарии.
+# Запуск из корня репозитория:
+#   python -m bench.run --output bench_output.txt
+#   python -m bench.run --scenarios start,search --tg-latency 0.05 --flood-rate 0.01
+#   python -m bench.run --save baseline.json   /   --compare baseline.json
+
+ALL_SCENARIOS = ("start", "buttons", "group", "search", "broadcast")
+REGRESSION_THRESHOLD = 0.2   # p99 или пропускная способность хуже на 20% — регрессия
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушками Telegram и RSS")
+    parser.add_argument("--scenarios", default=",".join(ALL_SCENARIOS),
+                        help=f"через запятую: {', '.join(ALL_SCENARIOS)}")
+    parser.add_argument("--workers", type=int, default=None, help="CONCURRENT_UPDATES бота")
+    parser.add_argument("--outbound-rate", type=float, default=None,
+                        help="OUTBOUND_GLOBAL_RATE бота, запросов в чаты в секунду")
+    parser.add_argument("--timeout", type=float, default=300, help="секунд на один сценарий")
+    # Размеры сценариев
+    parser.add_argument("--start-users", type=int, default=1000)
+    parser.add_argument("--button-users", type=int, default=200)
+    parser.add_argument("--presses", type=int, default=10, help="нажатий на пользователя")
+    parser.add_argument("--group-messages", type=int, default=3000)
+    parser.add_argument("--group-users", type=int, default=300)
+    parser.add_argument("--groups", type=int, default=3)
+    parser.add_argument("--spam-share", type=float, default=0.1)
+    parser.add_argument("--search-users", type=int, default=500)
+    parser.add_argument("--subscribers", type=int, default=10_000)
+    parser.add_argument("--broadcast-rate", type=float, default=None,
+                        help="сообщений в секунду; по умолчанию — BROADCAST_RATE бота")
+    parser.add_argument("--episodes", type=int, default=300, help="выпусков в ленте")
+    # Поведение заглушек
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="задержка Bot API, с")
+    parser.add_argument("--tg-jitter", type=float, default=0.01)
+    parser.add_argument("--tg-error-rate", type=float, default=0.0, help="доля ответов 502")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked-rate", type=float, default=0.01, help="доля подписчиков, заблокировавших бота")
+    parser.add_argument("--rss-latency", type=float, default=0.2)
+    parser.add_argument("--rss-error-rate", type=float, default=0.0)
+    # Отчёт
+    parser.add_argument("--output", help="дописать отчёт в файл")
+    parser.add_argument("--save", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", help="сравнить с сохранённым JSON; при регрессии код выхода 1")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+def install_config(api_url, workers, outbound_rate=None):
+    # Бот читает настройки из модуля config — подкладываем свой до импорта бота
+    config = types.ModuleType("config")
+    config.TOKEN = config.PODCAST_BOT = "123456:bench"
+    config.ADMINS = [1]
+    config.PODCAST_chat_id = 1
+    config.PODCAST_channel_id = -1001_999_999_999
+    config.TELEGRAM_API_URL = f"{api_url}/bot"
+    if workers:
+        config.CONCURRENT_UPDATES = workers
+    if outbound_rate:
+        config.OUTBOUND_GLOBAL_RATE = outbound_rate
+    sys.modules["config"] = config
+
+
+# ---------- ПАМЯТЬ ----------
+def rss_mb():
+    # Текущий RSS процесса; без /proc — пиковый
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def percentile_ms(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 1)
+
+
+# ---------- ПРОГОН ----------
+async def run_update_scenario(ctx, name):
+    tracker, telegram = ctx.tracker, ctx.telegram
+    tracker.reset()
+    calls_before = sum(telegram.calls.values())
+    dropped_before = ctx.metrics.UPDATES_DROPPED.total()
+
+    started = time.perf_counter()
+    sent = UPDATE_SCENARIOS[name](ctx)
+    finished = await tracker.wait(dropped_before, ctx.args.timeout)
+    elapsed = time.perf_counter() - started
+
+    latencies = tracker.latencies
+    return {
+        "updates": sent,
+        "done": len(latencies),
+        "dropped": int(ctx.metrics.UPDATES_DROPPED.total() - dropped_before),
+        "timed_out": not finished,
+        "p50_ms": percentile_ms(latencies, 0.5),
+        "p99_ms": percentile_ms(latencies, 0.99),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+        "per_second": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "api_calls": sum(telegram.calls.values()) - calls_before,
+        "rss_mb": round(rss_mb(), 1),
+    }
+
+
+async def run(args):
+    logging.basicConfig(level=args.log_level)
+    telegram = FakeTelegram(
+        Faults(args.tg_latency, args.tg_jitter, args.tg_error_rate),
+        flood_rate=args.flood_rate, retry_after=args.retry_after,
+    )
+    rss = FakeRSS(Faults(args.rss_latency, 0, args.rss_error_rate), episodes=args.episodes)
+    runner, base_url = await start_servers(telegram, rss)
+    install_config(base_url, args.workers, args.outbound_rate)
+
+    rss_before_import = rss_mb()
+    import CheTamNovosti as bot
+    import db
+    import metrics
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    # Бот настраивает логирование при импорте — возвращаем уровень стенда
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if args.broadcast_rate:
+        bot.BROADCAST_RATE = args.broadcast_rate
+    bot.FEEDS_CONFIG[0]["rss_url"] = f"{base_url}/rss.xml"
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        await bot.prepare_storage()
+        await bot.poll_feed(bot.get_feed())
+
+        app = bot.build_application()
+        bot.schedule_jobs(app.job_queue)
+        ctx = types.SimpleNamespace(args=args, bot=bot, db=db, metrics=metrics, app=app, telegram=telegram)
+        ctx.tracker = UpdateTracker(app, metrics.UPDATES_DROPPED)
+        app.add_handler(TypeHandler(Update, ctx.tracker.done), group=100)
+
+        async with app:
+            await app.start()
+            results["_env"] = {
+                "workers": app.update_processor.workers,
+                "episodes": len(bot.get_feed().episodes),
+                "rss_mb_before_import": round(rss_before_import, 1),
+                "rss_mb_ready": round(rss_mb(), 1),
+            }
+            for name in args.scenarios.split(","):
+                name = name.strip()
+                if name == "broadcast":
+                    results[name] = {**await broadcast(ctx), "rss_mb": round(rss_mb(), 1)}
+                elif name in UPDATE_SCENARIOS:
+                    results[name] = await run_update_scenario(ctx, name)
+                else:
+                    print(f"Неизвестный сценарий: {name}", file=sys.stderr)
+                    continue
+                print(format_line(name, results[name]), flush=True)
+            await app.stop()
+            await app.post_stop(app)
+        await app.post_shutdown(app)
+
+    results["_env"]["rss_mb_peak"] = round(peak_rss_mb(), 1)
+    results["_env"]["telegram_responses"] = {f"{m} {code}": n for (m, code), n in sorted(telegram.responses.items())}
+    results["_env"]["rss_responses"] = dict(rss.requests)
+    await runner.cleanup()
+    return results
+
+
+# ---------- ОТЧЁТ ----------
+def format_line(name, result):
+    if name == "broadcast":
+        return (
+            f"{name:<10} сообщений {result['messages']}: отправлено {result.get('sent', 0)}, "
+            f"недоступны {result.get('blocked', 0)}, ошибок {result.get('failed', 0)} "
+            f"за {result['seconds']} с — {result['per_second']} сообщ./с, память {result['rss_mb']} МБ"
+        )
+    return (
+        f"{name:<10} апдейтов {result['updates']}, обработано {result['done']}, отброшено {result['dropped']}"
+        f"{' (ТАЙМАУТ)' if result['timed_out'] else ''}: p50 {result['p50_ms']} мс, p99 {result['p99_ms']} мс, "
+        f"max {result['max_ms']} мс, {result['per_second']} апд./с, "
+        f"вызовов API {result['api_calls']}, память {result['rss_mb']} МБ"
+    )
+
+
+def format_report(args, results):
+    env = results["_env"]
+    lines = [
+        f"=== bench {time.strftime('%Y-%m-%d %H:%M:%S')} ===",
+        f"обработчиков {env['workers']}, выпусков {env['episodes']}, "
+        f"Bot API {args.tg_latency * 1000:g}±{args.tg_jitter * 1000:g} мс, 429 {args.flood_rate:.0%}, "
+        f"502 {args.tg_error_rate:.0%}, лента RSS {args.rss_latency * 1000:g} мс",
+    ]
+    lines += [format_line(name, result) for name, result in results.items() if not name.startswith("_")]
+    lines.append(
+        f"память: до импорта бота {env['rss_mb_before_import']} МБ, бот готов {env['rss_mb_ready']} МБ, "
+        f"пик {env['rss_mb_peak']} МБ"
+    )
+    lines.append("ответы Bot API: " + ", ".join(f"{key}: {n}" for key, n in env["telegram_responses"].items()))
+    return "\n".join(lines)
+
+
+def compare(results, baseline):
+    # Регрессии относительно сохранённого прогона: p99 выросла или скорость упала
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if name.startswith("_") or not old:
+            continue
+        if old.get("p99_ms") and result.get("p99_ms", 0) > old["p99_ms"] * (1 + REGRESSION_THRESHOLD):
+            regressions.append(f"{name}: p99 {old['p99_ms']} → {result['p99_ms']} мс")
+        if old.get("per_second") and result.get("per_second", 0) < old["per_second"] * (1 - REGRESSION_THRESHOLD):
+            regressions.append(f"{name}: скорость {old['per_second']} → {result['per_second']} в секунду")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    report = format_report(args, results)
+    print(report)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as output:
+            output.write(report + "\n\n")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as saved:
+            json.dump(results, saved, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as saved:
+            regressions = compare(results, json.load(saved))
+        for line in regressions:
+            print(f"РЕГРЕССИЯ {line}")
+        if regressions:
+            sys.exit(1)
+        print("Регрессий нет.")
+
+
+if __name__ == "__main__":
+    main()
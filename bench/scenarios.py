@@ -0,0 +1,165 @@
+import asyncio
+import itertools
+import random
+import time
+
+from telegram import Update
+
+from bench.fakes import BOT_ID, WORDS
+
+# ——————————————————————————————————————————————————————————
+# Сценарии нагрузки. Каждый кладёт синтетические апдейты в очередь настоящего
+# Application (как это делает webhook-сервер) и ждёт, пока их обработают.
+# Задержка апдейта — от попадания в очередь до конца последней группы хэндлеров.
+
+USER_IDS = itertools.count(10_000_000)
+UPDATE_IDS = itertools.count(1)
+MESSAGE_IDS = itertools.count(1)
+GROUP_CHAT_BASE = -1001_000_000_000
+SPAM_SAMPLES = ("купить со скидкой", "заходи на https://spam.example", "звони +7 999 123 45 67")
+
+
+class UpdateTracker:
+    # Время постановки апдейта в очередь и задержки обработанных апдейтов
+    def __init__(self, app, dropped_counter):
+        self.app = app
+        self.dropped_counter = dropped_counter
+        self.pending = {}
+        self.latencies = []
+
+    def submit(self, data):
+        update = Update.de_json(data, self.app.bot)
+        self.pending[update.update_id] = time.perf_counter()
+        self.app.update_queue.put_nowait(update)
+
+    async def done(self, update, context):
+        started = self.pending.pop(update.update_id, None)
+        if started is not None:
+            self.latencies.append(time.perf_counter() - started)
+
+    async def wait(self, dropped_before, timeout):
+        # Ждём, пока не останутся только отброшенные апдейты
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if len(self.pending) <= self.dropped_counter.total() - dropped_before:
+                return True
+            await asyncio.sleep(0.01)
+        return False
+
+    def reset(self):
+        self.pending.clear()
+        self.latencies = []
+
+
+# ---------- СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ----------
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+def message_update(user_id, text, chat_id=None, chat_type="private"):
+    chat_id = chat_id or user_id
+    message = {
+        "message_id": next(MESSAGE_IDS),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": chat_type},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(UPDATE_IDS), "message": message}
+
+
+def callback_update(user_id, data):
+    # Нажатие кнопки под сообщением бота в личке
+    return {
+        "update_id": next(UPDATE_IDS),
+        "callback_query": {
+            "id": str(next(MESSAGE_IDS)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(MESSAGE_IDS),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "bench"},
+                "text": "Добро пожаловать! Выберите одно из действий ниже:",
+            },
+        },
+    }
+
+
+# ---------- СЦЕНАРИИ ----------
+# Каждый сценарий возвращает количество отправленных апдейтов
+def start_burst(ctx):
+    # Рестарт бота или рекламный пост: все разом жмут /start
+    for _ in range(ctx.args.start_users):
+        ctx.tracker.submit(message_update(next(USER_IDS), "/start"))
+    return ctx.args.start_users
+
+
+def button_storm(ctx):
+    # Пользователи листают меню: случайные кнопки, по нескольку нажатий подряд
+    buttons = list(ctx.bot.BUTTON_HANDLERS)
+    sent = 0
+    users = [next(USER_IDS) for _ in range(ctx.args.button_users)]
+    for _ in range(ctx.args.presses):
+        for user_id in users:
+            ctx.tracker.submit(callback_update(user_id, random.choice(buttons)))
+            sent += 1
+    return sent
+
+
+def group_flood(ctx):
+    # Флуд в нескольких группах: в основном обычные сообщения, часть — спам
+    users = [next(USER_IDS) for _ in range(ctx.args.group_users)]
+    for i in range(ctx.args.group_messages):
+        chat_id = GROUP_CHAT_BASE - i % ctx.args.groups
+        text = " ".join(random.choices(WORDS, k=8))
+        if random.random() < ctx.args.spam_share:
+            text += " " + random.choice(SPAM_SAMPLES)
+        ctx.tracker.submit(message_update(random.choice(users), text, chat_id, "supergroup"))
+    return ctx.args.group_messages
+
+
+def search(ctx):
+    # Кнопка «Поиск», затем запрос из одного-двух слов
+    for _ in range(ctx.args.search_users):
+        user_id = next(USER_IDS)
+        ctx.tracker.submit(callback_update(user_id, "search"))
+        ctx.tracker.submit(message_update(user_id, " ".join(random.sample(WORDS, random.randint(1, 2)))))
+    return ctx.args.search_users * 2
+
+
+async def broadcast(ctx):
+    # Рассылка нового выпуска по всем подписчикам — тот же путь, что у автопостинга
+    bot, db = ctx.bot, ctx.db
+    feed = bot.get_feed()
+    subscribers = [next(USER_IDS) for _ in range(ctx.args.subscribers)]
+    ctx.telegram.blocked.update(random.sample(subscribers, int(len(subscribers) * ctx.args.blocked_rate)))
+    await db.executemany(
+        "INSERT OR IGNORE INTO subscriptions (user_id, feed_id, status, created_at) VALUES (?, ?, 'active', ?)",
+        [(user_id, feed.id, "bench") for user_id in subscribers]
+    )
+    text = bot.get_rendered(feed.episodes[-1], feed).post_text
+    job_id = await db.create_broadcast_job(feed.id, text)
+
+    started = time.perf_counter()
+    stats = await bot.run_broadcast_job(ctx.app.bot, job_id) or {}
+    elapsed = time.perf_counter() - started
+    await db.execute("DELETE FROM subscriptions WHERE feed_id = ? AND created_at = 'bench'", (feed.id,))
+    return {
+        "messages": ctx.args.subscribers,
+        "seconds": round(elapsed, 2),
+        "per_second": round(stats.get("sent", 0) / elapsed, 1) if elapsed else 0.0,
+        **stats,
+    }
+
+
+UPDATE_SCENARIOS = {
+    "start": start_burst,
+    "buttons": button_storm,
+    "group": group_flood,
+    "search": search,
+}
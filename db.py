@@ -0,0 +1,766 @@
+import asyncio
+import json
+import logging
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import aiosqlite
+
+import metrics
+
+# ——————————————————————————————————————————————————————————
+# Слой доступа к базе bot.db
+# Соединения открываются один раз при старте и живут до остановки бота:
+# один писатель (все записи идут через него под замком) и небольшой пул
+# читателей. WAL позволяет читать параллельно с записью, так что всплеск
+# /start не ловит "database is locked", а повторяющиеся запросы берутся
+# из кэша подготовленных выражений sqlite3.
+
+DB_PATH = "bot.db"
+READ_POOL_SIZE = 2
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",    # в WAL-режиме это безопасно и заметно быстрее FULL
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",     # 16 МБ страничного кэша
+    "PRAGMA mmap_size = 67108864",    # 64 МБ
+)
+
+_writer = None
+_readers = []
+_next_reader = 0
+_write_lock = asyncio.Lock()
+
+
+async def _open_connection():
+    conn = await aiosqlite.connect(DB_PATH, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        await conn.execute(pragma)
+    # Встроенный lower() в SQLite не знает кириллицу, даём питоновский
+    await conn.create_function("py_lower", 1, str.lower, deterministic=True)
+    return conn
+
+
+async def connect(path=None):
+    global DB_PATH, _writer, _readers
+    if _writer is not None:
+        return
+    if path:
+        DB_PATH = path
+    _writer = await _open_connection()
+    _readers = [await _open_connection() for _ in range(READ_POOL_SIZE)]
+    logging.info(f"База {DB_PATH} открыта: 1 писатель, читателей: {READ_POOL_SIZE}.")
+
+
+async def close():
+    global _writer, _readers
+    for conn in [_writer, *_readers]:
+        if conn is not None:
+            try:
+                await conn.close()
+            except Exception as e:
+                logging.error(f"Ошибка при закрытии соединения с базой: {e}")
+    _writer, _readers = None, []
+
+
+def _reader():
+    global _next_reader
+    _next_reader = (_next_reader + 1) % len(_readers)
+    return _readers[_next_reader]
+
+
+async def fetchone(sql, params=()):
+    with metrics.DB_QUERY_SECONDS.time(op="read"):
+        cur = await _reader().execute(sql, params)
+        return await cur.fetchone()
+
+
+async def fetchall(sql, params=()):
+    with metrics.DB_QUERY_SECONDS.time(op="read"):
+        cur = await _reader().execute(sql, params)
+        return await cur.fetchall()
+
+
+@asynccontextmanager
+async def transaction():
+    # Все записи — через единственного писателя; коммит или откат в конце блока
+    # Время считаем вместе с ожиданием замка — это и есть задержка для вызывающего
+    with metrics.DB_QUERY_SECONDS.time(op="write"):
+        async with _write_lock:
+            try:
+                yield _writer
+                await _writer.commit()
+            except BaseException:
+                await _writer.rollback()
+                raise
+
+
+async def execute(sql, params=()):
+    async with transaction() as conn:
+        cur = await conn.execute(sql, params)
+        return cur.rowcount
+
+
+async def executemany(sql, rows):
+    async with transaction() as conn:
+        await conn.executemany(sql, rows)
+
+
+# ——————————————————————————————————————————————————————————
+# SQL модели: users, actions, subscriptions, settings, moderation_logs, feeds,
+# episodes (+ episodes_fts), seen_episodes, broadcast_jobs, broadcast_deliveries
+
+SCHEMA = {
+    "users": """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_seen TEXT
+        )
+    """,
+    "actions": """
+        CREATE TABLE IF NOT EXISTS actions (
+            id       INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id  INTEGER,
+            action   TEXT,
+            time     TEXT
+        )
+    """,
+    "settings": """
+        CREATE TABLE IF NOT EXISTS settings (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """,
+    "moderation_logs": """
+        CREATE TABLE IF NOT EXISTS moderation_logs (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id     INTEGER,
+            username    TEXT,
+            reason      TEXT,
+            timestamp   TEXT
+        )
+    """,
+    "feeds": """
+        CREATE TABLE IF NOT EXISTS feeds (
+            id               INTEGER PRIMARY KEY AUTOINCREMENT,
+            slug             TEXT NOT NULL UNIQUE,
+            title            TEXT,
+            rss_url          TEXT NOT NULL,
+            site_link        TEXT,
+            channel_id       INTEGER,
+            platform_links   TEXT,
+            active           INTEGER NOT NULL DEFAULT 1,
+            etag             TEXT,
+            last_modified    TEXT,
+            last_posted_url  TEXT,
+            seen_backfilled  INTEGER NOT NULL DEFAULT 0,
+            created_at       TEXT
+        )
+    """,
+    "subscriptions": """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id     INTEGER NOT NULL,
+            feed_id     INTEGER NOT NULL DEFAULT 1,
+            status      TEXT NOT NULL DEFAULT 'active',
+            created_at  TEXT,
+            PRIMARY KEY (user_id, feed_id)
+        )
+    """,
+    "broadcast_jobs": """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id           INTEGER PRIMARY KEY AUTOINCREMENT,
+            feed_id      INTEGER,
+            text         TEXT,
+            status       TEXT NOT NULL DEFAULT 'running',
+            created_at   TEXT,
+            finished_at  TEXT,
+            sent         INTEGER NOT NULL DEFAULT 0,
+            blocked      INTEGER NOT NULL DEFAULT 0,
+            failed       INTEGER NOT NULL DEFAULT 0
+        )
+    """,
+    "broadcast_deliveries": """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id      INTEGER NOT NULL,
+            user_id     INTEGER NOT NULL,
+            status      TEXT NOT NULL DEFAULT 'pending',
+            updated_at  TEXT,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+    """,
+    "moderation_rules": """
+        CREATE TABLE IF NOT EXISTS moderation_rules (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind        TEXT NOT NULL,
+            pattern     TEXT NOT NULL,
+            created_at  TEXT,
+            UNIQUE (kind, pattern)
+        )
+    """,
+    "episodes": """
+        CREATE TABLE IF NOT EXISTS episodes (
+            feed_id      INTEGER NOT NULL DEFAULT 1,
+            guid         TEXT NOT NULL,
+            title        TEXT,
+            url          TEXT,
+            description  TEXT,
+            clean_text   TEXT,
+            published    TEXT,
+            updated_at   TEXT,
+            PRIMARY KEY (feed_id, guid)
+        )
+    """,
+    "seen_episodes": """
+        CREATE TABLE IF NOT EXISTS seen_episodes (
+            feed_id  INTEGER NOT NULL,
+            guid     TEXT NOT NULL,
+            posted   INTEGER NOT NULL DEFAULT 0,
+            seen_at  TEXT,
+            PRIMARY KEY (feed_id, guid)
+        ) WITHOUT ROWID
+    """,
+}
+
+# Индексы под горячие запросы. Создаются после миграций, когда у таблиц уже есть feed_id
+INDEXES = {
+    # Получатели рассылки: активные подписчики ленты по порядку user_id
+    # (первичный ключ начинается с user_id и для этого запроса не годится)
+    "subscriptions_active": """
+        CREATE INDEX IF NOT EXISTS subscriptions_active ON subscriptions (feed_id, status, user_id)
+    """,
+}
+
+# В исходной базе (версия с одной лентой) subscriptions заводилась вручную и
+# feed_id в ней нет: пересобираем таблицу целиком, все подписки достаются
+# ленте по умолчанию (id = 1). Остальные таблицы лент в той версии не было
+PER_FEED_TABLES = ("subscriptions",)
+
+
+async def _columns(conn, table):
+    cur = await conn.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in await cur.fetchall()}
+
+
+async def migrate_to_feeds(conn):
+    for table in PER_FEED_TABLES:
+        columns = await _columns(conn, table)
+        if "feed_id" in columns:
+            continue
+        await conn.execute(f"ALTER TABLE {table} RENAME TO {table}_single_feed")
+        await conn.execute(SCHEMA[table])
+        shared = ", ".join(sorted(columns & await _columns(conn, table)))
+        await conn.execute(
+            f"INSERT INTO {table} (feed_id, {shared}) SELECT 1, {shared} FROM {table}_single_feed"
+        )
+        await conn.execute(f"DROP TABLE {table}_single_feed")
+        logging.info(f"Таблица {table} переведена на несколько лент.")
+
+
+async def init_db():
+    try:
+        async with transaction() as conn:
+            for table, ddl in SCHEMA.items():
+                try:
+                    await conn.execute(ddl)
+                except Exception as e:
+                    logging.error(f"Ошибка при создании таблицы {table}: {e}")
+            await migrate_to_feeds(conn)
+            for index, ddl in INDEXES.items():
+                try:
+                    await conn.execute(ddl)
+                except Exception as e:
+                    logging.error(f"Ошибка при создании индекса {index}: {e}")
+            await init_episodes_fts(conn)
+    except Exception as e:
+        logging.error(f"Ошибка при инициализации базы данных: {e}")
+
+
+# ---------- НАСТРОЙКИ ----------
+async def get_setting(key, default=None):
+    try:
+        row = await fetchone("SELECT value FROM settings WHERE key = ?", (key,))
+        return row[0] if row and row[0] != "" else default
+    except Exception as e:
+        logging.error(f"Ошибка чтения настройки {key}: {e}")
+        return default
+
+
+async def set_setting(key, value):
+    try:
+        await execute("REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+    except Exception as e:
+        logging.error(f"Ошибка записи настройки {key}: {e}")
+
+
+# ---------- ПОЛЬЗОВАТЕЛИ И СТАТИСТИКА ----------
+# Отложенная запись: upsert пользователей и события нажатий копятся в памяти
+# и сбрасываются одной транзакцией раз в FLUSH_INTERVAL секунд, при
+# накоплении FLUSH_MAX_ROWS строк и при остановке бота.
+FLUSH_INTERVAL = 2.0
+FLUSH_MAX_ROWS = 500
+
+_pending_users = {}     # user_id -> (username, first_name, last_seen)
+_pending_actions = []   # (user_id, action, time)
+_flush_lock = asyncio.Lock()
+_flush_tasks = set()    # сильные ссылки: event loop держит задачи только слабо
+
+
+def queue_user(user_id, username, first_name, last_seen):
+    # Для одного пользователя достаточно последней версии
+    _pending_users[user_id] = (username, first_name, last_seen)
+    _maybe_flush()
+
+
+def queue_action(user_id, action, time):
+    _pending_actions.append((user_id, action, time))
+    _maybe_flush()
+
+
+def _maybe_flush():
+    if len(_pending_users) + len(_pending_actions) >= FLUSH_MAX_ROWS and not _flush_lock.locked() and not _flush_tasks:
+        task = asyncio.get_running_loop().create_task(flush_pending_writes())
+        _flush_tasks.add(task)
+        task.add_done_callback(_flush_done)
+
+
+def _flush_done(task):
+    _flush_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Ошибка фоновой записи буфера: {task.exception()}")
+
+
+async def drain_pending_writes():
+    # При остановке: дождаться начатых сбросов и записать остаток буфера
+    if _flush_tasks:
+        await asyncio.gather(*_flush_tasks, return_exceptions=True)
+    await flush_pending_writes()
+
+
+async def flush_pending_writes():
+    global _pending_users, _pending_actions
+    async with _flush_lock:
+        if not _pending_users and not _pending_actions:
+            return
+        # Забираем буферы целиком: новые события копятся уже в свежих
+        users, actions = _pending_users, _pending_actions
+        _pending_users, _pending_actions = {}, []
+        try:
+            async with transaction() as conn:
+                await conn.executemany("""
+                    INSERT INTO users (user_id, username, first_name, last_seen)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        first_name = excluded.first_name,
+                        last_seen = excluded.last_seen
+                """, [(uid, *values) for uid, values in users.items()])
+                await conn.executemany(
+                    "INSERT INTO actions (user_id, action, time) VALUES (?, ?, ?)",
+                    actions
+                )
+        except Exception as e:
+            logging.error(f"Ошибка отложенной записи ({len(users)} польз., {len(actions)} действий): {e}")
+            # Возвращаем несохранённое в буфер, более свежие данные не затираем
+            for uid, values in users.items():
+                _pending_users.setdefault(uid, values)
+            _pending_actions[:0] = actions
+
+
+async def get_stats():
+    row = await fetchone("SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM actions)")
+    return row[0], row[1]
+
+
+# ---------- ПРАВИЛА МОДЕРАЦИИ ----------
+# kind: 'word' — запрещённые слова в чате, 'regex' — шаблоны по сырому тексту
+# (ссылки, телефоны), 'search' — слова, по которым не ищем
+async def seed_moderation_rules(rows):
+    # Заполняем правила значениями по умолчанию только при первом запуске
+    try:
+        async with transaction() as conn:
+            cur = await conn.execute("SELECT COUNT(*) FROM moderation_rules")
+            if (await cur.fetchone())[0]:
+                return
+            now = datetime.utcnow().isoformat()
+            await conn.executemany(
+                "INSERT OR IGNORE INTO moderation_rules (kind, pattern, created_at) VALUES (?, ?, ?)",
+                [(kind, pattern, now) for kind, pattern in rows]
+            )
+        logging.info(f"Записаны правила модерации по умолчанию: {len(rows)}.")
+    except Exception as e:
+        logging.error(f"Ошибка при записи правил модерации: {e}")
+
+
+async def load_moderation_rules():
+    # [(kind, pattern)] или None, если базу прочитать не удалось
+    try:
+        return await fetchall("SELECT kind, pattern FROM moderation_rules ORDER BY id")
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке правил модерации: {e}")
+        return None
+
+
+# ---------- КАТАЛОГ ЭПИЗОДОВ (FTS5) ----------
+# Trigram-токенайзер ищет по подстрокам, поэтому «новост» находит и «новости»,
+# и «новостях». На старых SQLite (< 3.34) откатываемся на unicode61 с префиксами.
+FTS_TRIGRAM = True
+
+# Окончания для грубого стемминга русских слов в запросе (длинные — первыми)
+RU_ENDINGS = sorted((
+    "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "иях", "ях", "ах",
+    "ов", "ев", "ей", "ий", "ый", "ой", "ая", "яя", "ое", "ее", "ие", "ые",
+    "ую", "юю", "ом", "ем", "ам", "ям", "ть", "ся", "сь",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й"
+), key=len, reverse=True)
+
+# Маркеры подсветки в сниппетах: заменяются на <b></b> уже после экранирования
+SNIPPET_START, SNIPPET_END = "\x02", "\x03"
+# В trigram-индексе «токен» — это три буквы, так что окно сниппета берём максимальное
+SNIPPET_TOKENS = 64
+
+
+async def init_episodes_fts(conn):
+    global FTS_TRIGRAM
+    try:
+        await conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS episodes_fts
+            USING fts5(feed_id UNINDEXED, guid UNINDEXED, title, body, tokenize='trigram')
+        """)
+    except aiosqlite.OperationalError:
+        await conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS episodes_fts
+            USING fts5(feed_id UNINDEXED, guid UNINDEXED, title, body, tokenize='unicode61 remove_diacritics 2')
+        """)
+    cur = await conn.execute("SELECT sql FROM sqlite_master WHERE name = 'episodes_fts'")
+    FTS_TRIGRAM = "trigram" in (await cur.fetchone())[0]
+
+
+def normalize_search_text(text: str) -> str:
+    # Регистр FTS5 игнорирует сам, а «ё» приводим к «е» и в индексе, и в запросе
+    return (text or "").replace("ё", "е").replace("Ё", "Е")
+
+
+def stem_word(word: str) -> str:
+    # Отрезаем окончание, оставляя у слова хотя бы 3 буквы основы
+    for ending in RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def build_fts_query(query: str):
+    # Каждое слово запроса — обязательное условие (неявный AND в FTS5)
+    terms = []
+    for word in re.findall(r"\w+", normalize_search_text(query).lower()):
+        stem = stem_word(word)
+        if FTS_TRIGRAM:
+            if len(stem) >= 3:
+                terms.append(f'"{stem}"')
+        else:
+            terms.append(f'"{stem}"*')
+    return " ".join(terms)
+
+
+async def save_episodes(feed_id, rows):
+    # rows: [(episode, clean_text)] — upsert в каталог ленты и в полнотекстовый индекс
+    if not rows:
+        return
+    now = datetime.utcnow().isoformat()
+    try:
+        async with transaction() as conn:
+            for ep, clean_text in rows:
+                await conn.execute("""
+                    INSERT INTO episodes (feed_id, guid, title, url, description, clean_text, published, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(feed_id, guid) DO UPDATE SET
+                        title = excluded.title,
+                        url = excluded.url,
+                        description = excluded.description,
+                        clean_text = excluded.clean_text,
+                        published = excluded.published,
+                        updated_at = excluded.updated_at
+                """, (
+                    feed_id, ep.guid, ep.title, ep.url, ep.description, clean_text,
+                    ep.published.isoformat() if ep.published else None, now
+                ))
+                await conn.execute(
+                    "DELETE FROM episodes_fts WHERE feed_id = ? AND guid = ?", (feed_id, ep.guid)
+                )
+                await conn.execute(
+                    "INSERT INTO episodes_fts (feed_id, guid, title, body) VALUES (?, ?, ?, ?)",
+                    (feed_id, ep.guid, normalize_search_text(ep.title), normalize_search_text(clean_text))
+                )
+        logging.info(f"Каталог эпизодов ленты #{feed_id} обновлён: {len(rows)}.")
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении эпизодов ленты #{feed_id} в каталог: {e}")
+
+
+async def load_episodes(feed_id):
+    # [(title, url, description, guid, published)], свежие — первыми
+    try:
+        return await fetchall("""
+            SELECT title, url, description, guid, published
+            FROM episodes WHERE feed_id = ? ORDER BY published DESC
+        """, (feed_id,))
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке каталога ленты #{feed_id}: {e}")
+        return []
+
+
+async def search_episodes(query: str, limit: int, feed_id: int):
+    # Один индексированный запрос: [(title, url, snippet, guid)], лучшие совпадения — первыми
+    fts_query = build_fts_query(query)
+    try:
+        if fts_query:
+            return await fetchall("""
+                SELECT e.title, e.url,
+                       snippet(episodes_fts, 3, ?, ?, '…', ?), e.guid
+                FROM episodes_fts
+                JOIN episodes e ON e.feed_id = episodes_fts.feed_id AND e.guid = episodes_fts.guid
+                WHERE episodes_fts MATCH ? AND episodes_fts.feed_id = ?
+                ORDER BY bm25(episodes_fts, 0.0, 0.0, 10.0, 1.0)
+                LIMIT ?
+            """, (SNIPPET_START, SNIPPET_END, SNIPPET_TOKENS if FTS_TRIGRAM else 12, fts_query, feed_id, limit))
+        # Слишком короткий запрос для trigram — простой поиск по названиям
+        return await fetchall("""
+            SELECT e.title, e.url, '', e.guid
+            FROM episodes_fts
+            JOIN episodes e ON e.feed_id = episodes_fts.feed_id AND e.guid = episodes_fts.guid
+            WHERE episodes_fts.feed_id = ? AND instr(py_lower(episodes_fts.title), ?) > 0
+            ORDER BY e.published DESC
+            LIMIT ?
+        """, (feed_id, normalize_search_text(query).lower(), limit))
+    except Exception as e:
+        logging.error(f"Ошибка полнотекстового поиска по запросу {query!r}: {e}")
+        return []
+
+
+# ---------- РЕЕСТР ЛЕНТ ----------
+# Каждая лента — строка в feeds со своим каналом, ссылками на платформы и
+# валидаторами HTTP-кэша. Эпизоды, подписки и рассылки привязаны к feed_id.
+FEED_COLUMNS = "id, slug, title, rss_url, site_link, channel_id, platform_links, etag, last_modified"
+
+
+async def seed_feeds(feeds):
+    # feeds: [dict(slug, title, rss_url, site_link, channel_id, platform_links)].
+    # Ленты из настроек добавляются или обновляются по slug; ленты, заведённые
+    # прямо в базе, не трогаем. Первая лента — лента по умолчанию, ей достаётся
+    # last_posted_url из версии с одной лентой.
+    now = datetime.utcnow().isoformat()
+    try:
+        async with transaction() as conn:
+            cur = await conn.execute("SELECT COUNT(*) FROM feeds")
+            first_run = not (await cur.fetchone())[0]
+            for feed in feeds:
+                await conn.execute("""
+                    INSERT INTO feeds
+                        (slug, title, rss_url, site_link, channel_id, platform_links, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(slug) DO UPDATE SET
+                        title = excluded.title,
+                        rss_url = excluded.rss_url,
+                        site_link = excluded.site_link,
+                        channel_id = excluded.channel_id,
+                        platform_links = excluded.platform_links
+                """, (
+                    feed["slug"], feed.get("title"), feed["rss_url"], feed.get("site_link"),
+                    feed.get("channel_id"), json.dumps(feed.get("platform_links", []), ensure_ascii=False), now
+                ))
+            if first_run and feeds:
+                await conn.execute("""
+                    UPDATE feeds SET
+                        last_posted_url = (SELECT value FROM settings WHERE key = 'last_posted_url')
+                    WHERE slug = ?
+                """, (feeds[0]["slug"],))
+    except Exception as e:
+        logging.error(f"Ошибка при записи реестра лент: {e}")
+
+
+async def load_feeds():
+    # Активные ленты: [(id, slug, title, rss_url, site_link, channel_id, platform_links, etag, last_modified)]
+    try:
+        rows = await fetchall(f"SELECT {FEED_COLUMNS} FROM feeds WHERE active = 1 ORDER BY id")
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке реестра лент: {e}")
+        return None
+    return [(*row[:6], json.loads(row[6] or "[]"), *row[7:]) for row in rows]
+
+
+async def set_feed_validators(feed_id, etag, last_modified):
+    try:
+        await execute(
+            "UPDATE feeds SET etag = ?, last_modified = ? WHERE id = ?",
+            (etag, last_modified, feed_id)
+        )
+    except Exception as e:
+        logging.error(f"Ошибка записи валидаторов ленты #{feed_id}: {e}")
+
+
+# ---------- ПОДПИСКИ ----------
+async def set_subscription(user_id, feed_id, active):
+    # Подписка или отписка; повторная подписка возвращает прежнюю строку в 'active'
+    await execute("""
+        INSERT INTO subscriptions (user_id, feed_id, status, created_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, feed_id) DO UPDATE SET status = excluded.status
+    """, (user_id, feed_id, "active" if active else "inactive", datetime.utcnow().isoformat()))
+
+
+async def is_subscribed(user_id, feed_id):
+    row = await fetchone(
+        "SELECT status FROM subscriptions WHERE user_id = ? AND feed_id = ?", (user_id, feed_id)
+    )
+    return bool(row and row[0] == "active")
+
+
+async def deactivate_subscribers(user_ids):
+    # Пользователи заблокировали бота или удалили аккаунт — больше им не пишем (во всех лентах)
+    if not user_ids:
+        return
+    try:
+        await executemany(
+            "UPDATE subscriptions SET status = 'inactive' WHERE user_id = ?",
+            [(uid,) for uid in user_ids]
+        )
+        logging.info(f"Отключены подписки недоступных пользователей: {len(user_ids)}.")
+    except Exception as e:
+        logging.error(f"Ошибка при отключении подписок: {e}")
+
+
+# ---------- ВИДЕННЫЕ ВЫПУСКИ ----------
+# guid всех выпусков ленты, которые бот уже опубликовал или сознательно
+# пропустил. Новый выпуск — любой guid из RSS, которого здесь нет.
+async def load_seen_guids(feed_id):
+    # Множество guid; None — лента ещё ни разу не заполнялась (нужен backfill)
+    row = await fetchone("SELECT seen_backfilled FROM feeds WHERE id = ?", (feed_id,))
+    if not row or not row[0]:
+        return None
+    return {guid for (guid,) in await fetchall("SELECT guid FROM seen_episodes WHERE feed_id = ?", (feed_id,))}
+
+
+async def mark_episodes_seen(feed_id, guids, backfill=False):
+    # Отмечает выпуски виденными без публикации. backfill=True — первое
+    # заполнение ленты: после него load_seen_guids перестаёт возвращать None
+    now = datetime.utcnow().isoformat()
+    async with transaction() as conn:
+        await conn.executemany(
+            "INSERT OR IGNORE INTO seen_episodes (feed_id, guid, posted, seen_at) VALUES (?, ?, 0, ?)",
+            [(feed_id, guid, now) for guid in guids]
+        )
+        if backfill:
+            await conn.execute("UPDATE feeds SET seen_backfilled = 1 WHERE id = ?", (feed_id,))
+
+
+async def get_last_posted_url(feed_id):
+    # Последний опубликованный выпуск из версий до seen_episodes — нужен
+    # только один раз, при первом заполнении ленты
+    row = await fetchone("SELECT last_posted_url FROM feeds WHERE id = ?", (feed_id,))
+    return row[0] if row and row[0] else None
+
+
+# ---------- ЗАДАНИЯ РАССЫЛКИ ----------
+async def create_broadcast_job(feed_id, text, guid=None, chat_ids=()):
+    # Задание + получатели (активные подписчики ленты и chat_ids) одной транзакцией.
+    # Там же отмечаем выпуск виденным, чтобы не опубликовать его дважды после падения.
+    now = datetime.utcnow().isoformat()
+    async with transaction() as conn:
+        cur = await conn.execute(
+            "INSERT INTO broadcast_jobs (feed_id, text, status, created_at) VALUES (?, ?, 'running', ?)",
+            (feed_id, text, now)
+        )
+        job_id = cur.lastrowid
+        await conn.executemany(
+            "INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id, updated_at) VALUES (?, ?, ?)",
+            [(job_id, chat_id, now) for chat_id in chat_ids]
+        )
+        await conn.execute("""
+            INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id, updated_at)
+            SELECT ?, user_id, ? FROM subscriptions WHERE feed_id = ? AND status = 'active'
+        """, (job_id, now, feed_id))
+        if guid is not None:
+            await conn.execute("""
+                INSERT INTO seen_episodes (feed_id, guid, posted, seen_at) VALUES (?, ?, 1, ?)
+                ON CONFLICT(feed_id, guid) DO UPDATE SET posted = 1
+            """, (feed_id, guid, now))
+    return job_id
+
+
+async def get_broadcast_text(job_id):
+    row = await fetchone("SELECT text FROM broadcast_jobs WHERE id = ?", (job_id,))
+    return row[0] if row else None
+
+
+async def claim_pending_deliveries(job_id, after_id, limit):
+    # Следующая пачка получателей (keyset по user_id), сразу помечается 'sending'
+    async with transaction() as conn:
+        cur = await conn.execute("""
+            SELECT user_id FROM broadcast_deliveries
+            WHERE job_id = ? AND status = 'pending' AND (? IS NULL OR user_id > ?)
+            ORDER BY user_id LIMIT ?
+        """, (job_id, after_id, after_id, limit))
+        chat_ids = [uid for (uid,) in await cur.fetchall()]
+        await conn.executemany(
+            "UPDATE broadcast_deliveries SET status = 'sending' WHERE job_id = ? AND user_id = ?",
+            [(job_id, uid) for uid in chat_ids]
+        )
+    return chat_ids
+
+
+async def iter_pending_deliveries(job_id, batch_size):
+    # Получатели задания пачками по batch_size: keyset по user_id,
+    # в памяти — только текущая пачка, сколько бы ни было подписчиков
+    last_id = None
+    while True:
+        chat_ids = await claim_pending_deliveries(job_id, last_id, batch_size)
+        if not chat_ids:
+            return
+        last_id = chat_ids[-1]
+        yield chat_ids
+
+
+async def checkpoint_deliveries(job_id, results):
+    # Статусы пачки и счётчики задания — одной транзакцией
+    now = datetime.utcnow().isoformat()
+    counts = list(results.values())
+    async with transaction() as conn:
+        await conn.executemany(
+            "UPDATE broadcast_deliveries SET status = ?, updated_at = ? WHERE job_id = ? AND user_id = ?",
+            [(result, now, job_id, uid) for uid, result in results.items()]
+        )
+        await conn.execute("""
+            UPDATE broadcast_jobs
+            SET sent = sent + ?, blocked = blocked + ?, failed = failed + ?
+            WHERE id = ?
+        """, (counts.count("sent"), counts.count("blocked"), counts.count("failed"), job_id))
+
+
+async def finish_broadcast_job(job_id):
+    await execute(
+        "UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE id = ?",
+        (datetime.utcnow().isoformat(), job_id)
+    )
+
+
+async def unfinished_broadcast_jobs(exclude=()):
+    # Незавершённые задания; получатели, застрявшие в 'sending', становятся 'unknown'.
+    # exclude — задания, которые сейчас выполняются: их пачка в 'sending' настоящая.
+    # Читаем его уже под замком писателя, когда новую пачку взять нельзя
+    async with transaction() as conn:
+        skip = set(exclude)
+        cur = await conn.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+        job_ids = [job_id for (job_id,) in await cur.fetchall() if job_id not in skip]
+        stuck = 0
+        for job_id in job_ids:
+            cur = await conn.execute(
+                "UPDATE broadcast_deliveries SET status = 'unknown' WHERE job_id = ? AND status = 'sending'",
+                (job_id,)
+            )
+            stuck += cur.rowcount
+        if stuck:
+            logging.warning(f"Получателей с неизвестным статусом в прерванных рассылках: {stuck}.")
+    return job_ids
@@ -0,0 +1,203 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# ——————————————————————————————————————————————————————————
+# Метрики в формате Prometheus без внешних зависимостей.
+# Счётчики и гистограммы живут в памяти процесса; render() отдаёт их
+# текстом для /metrics, а summary() — короткую сводку для /stats.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = defaultdict(float)
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        self.values[_label_key(labels)] += amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0.0)
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(key)} {value:g}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[_label_key(labels)] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        # key -> [счётчики по корзинам..., +Inf], сумма
+        self.counts = {}
+        self.sums = defaultdict(float)
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        return sum(self.counts.get(_label_key(labels), ()))
+
+    def quantile(self, fraction, key):
+        # Оценка по корзинам: верхняя граница корзины, куда попал квантиль
+        counts = self.counts.get(key)
+        if not counts:
+            return 0.0
+        target = fraction * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def render(self):
+        for key in sorted(self.counts):
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts[key]):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(key, [('le', f'{bound:g}')])} {cumulative}"
+            cumulative += self.counts[key][-1]
+            yield f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(key)} {self.sums[key]:g}"
+            yield f"{self.name}_count{_format_labels(key)} {cumulative}"
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- МЕТРИКИ БОТА ----------
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время работы хэндлеров кнопок и команд")
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Задержка апдейта от приёма webhook до конца обработки")
+UPDATES_DROPPED = Counter("bot_updates_dropped_total", "Апдейты, отброшенные без обработки: перегрузка чата или повторное нажатие")
+FLOOD_THROTTLED = Counter("bot_flood_throttled_total", "Нажатия и команды, отклонённые флуд-контролем")
+
+RSS_FETCH_SECONDS = Histogram("bot_rss_fetch_seconds", "Скачивание RSS")
+RSS_PARSE_SECONDS = Histogram("bot_rss_parse_seconds", "Разбор RSS feedparser'ом")
+RSS_FETCHES = Counter("bot_rss_fetches_total", "Запросы RSS по результату")
+FEED_POLL_INTERVAL = Gauge("bot_feed_poll_interval_seconds", "Текущий интервал опроса ленты")
+
+SCREEN_UPDATES = Counter("bot_screen_updates_total", "Показы экранов меню: edited, unchanged или sent")
+
+CACHE_REQUESTS = Counter("bot_cache_requests_total", "Обращения к кэшам по результату (hit/miss)")
+
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "Время запросов к SQLite", buckets=(
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0
+))
+
+TELEGRAM_API_REQUESTS = Counter("bot_telegram_api_requests_total", "Запросы к Bot API по методу и коду ответа")
+TELEGRAM_API_SECONDS = Histogram("bot_telegram_api_seconds", "Время запросов к Bot API")
+OUTBOUND_WAIT_SECONDS = Histogram("bot_outbound_wait_seconds", "Ожидание запроса в очереди исходящих (лимиты чата и бота)")
+OUTBOUND_RETRIES = Counter("bot_outbound_retries_total", "Повторы запросов к Bot API по причине")
+
+BROADCAST_MESSAGES = Counter("bot_broadcast_messages_total", "Сообщения рассылки по результату")
+BROADCAST_RATE = Gauge("bot_broadcast_rate", "Скорость последней рассылки, сообщений в секунду")
+
+MODERATION_DELETED = Counter("bot_moderation_deleted_total", "Сообщения, удалённые модерацией")
+MODERATION_WARNINGS = Counter("bot_moderation_warnings_total", "Предупреждения модерации: sent, merged или dropped")
+
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Время от запуска процесса до этапа старта")
+
+
+def summary():
+    # Короткая сводка для /stats
+    lines = []
+    handlers = sorted(HANDLER_SECONDS.counts, key=lambda key: -sum(HANDLER_SECONDS.counts[key]))
+    for key in handlers[:8]:
+        name = dict(key).get("handler", "?")
+        lines.append(
+            f"• {name}: вызовов {sum(HANDLER_SECONDS.counts[key])}, "
+            f"p50 ≤ {HANDLER_SECONDS.quantile(0.5, key) * 1000:g} мс, "
+            f"p99 ≤ {HANDLER_SECONDS.quantile(0.99, key) * 1000:g} мс"
+        )
+
+    hits = sum(v for k, v in CACHE_REQUESTS.values.items() if dict(k).get("result") == "hit")
+    total = CACHE_REQUESTS.total()
+    api_errors = sum(
+        v for k, v in TELEGRAM_API_REQUESTS.values.items() if dict(k).get("status") != "200"
+    )
+    not_modified = sum(v for k, v in RSS_FETCHES.values.items() if dict(k).get("status") == "304")
+    lines.append(f"📡 RSS: запросов {RSS_FETCHES.total():g}, из них 304: {not_modified:g}")
+    lines.append(f"🗂 Кэши: попаданий {hits:g} из {total:g}" if total else "🗂 Кэши: обращений не было")
+    lines.append(f"🧭 Меню: правок {SCREEN_UPDATES.get(result='edited'):g}, "
+                 f"без изменений {SCREEN_UPDATES.get(result='unchanged'):g}, "
+                 f"новых сообщений {SCREEN_UPDATES.get(result='sent'):g}")
+    lines.append(f"🤖 Bot API: запросов {TELEGRAM_API_REQUESTS.total():g}, ошибок {api_errors:g}, "
+                 f"повторов {OUTBOUND_RETRIES.total():g}")
+    lines.append(f"📬 Рассылка: отправлено {BROADCAST_MESSAGES.get(result='sent'):g}, "
+                 f"последняя — {BROADCAST_RATE.get():g} сообщ./с")
+    lines.append(f"🧹 Модерация: удалено {MODERATION_DELETED.total():g}, "
+                 f"предупреждений {MODERATION_WARNINGS.get(result='sent'):g} "
+                 f"(объединено {MODERATION_WARNINGS.get(result='merged'):g}, "
+                 f"пропущено {MODERATION_WARNINGS.get(result='dropped'):g})")
+    lines.append(f"🐢 Флуд-контроль: отклонено {FLOOD_THROTTLED.total():g}, "
+                 f"повторных нажатий {UPDATES_DROPPED.get(reason='duplicate'):g}")
+    stages = {dict(key).get("stage"): value for key, value in STARTUP_SECONDS.values.items()}
+    if "ready" in stages:
+        first = stages.get("first_response")
+        lines.append(
+            f"🚀 Старт: апдейты принимаются через {stages['ready']:g} с, "
+            + (f"первый ответ — через {first:g} с" if first is not None else "ответов ещё не было")
+        )
+    return "\n".join(lines)
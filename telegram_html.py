@@ -0,0 +1,178 @@
+import logging
+import re
+from html import escape, unescape
+from html.parser import HTMLParser
+
+# ——————————————————————————————————————————————————————————
+# Перевод HTML из RSS в подмножество HTML, которое понимает Telegram.
+# Разрешённые теги сохраняются (с приведением синонимов: strong → b и т.п.),
+# всё остальное превращается в экранированный текст. Длина считается в
+# видимых символах UTF-16, как её считает Telegram, и обрезка никогда
+# не режет тег или HTML-сущность: текст обрезается до экранирования,
+# а открытые теги закрываются в конце.
+
+TELEGRAM_TEXT_LIMIT = 4096  # видимых символов в одном сообщении
+
+TAG_ALIASES = {
+    "b": "b", "strong": "b",
+    "i": "i", "em": "i",
+    "u": "u", "ins": "u",
+    "s": "s", "strike": "s", "del": "s",
+    "a": "a",
+}
+# Теги-блоки превращаются в переносы строк: сколько пустых строк ставить
+BLOCK_BREAKS = {
+    "p": 2, "ul": 2, "ol": 2, "blockquote": 2, "pre": 2, "table": 2, "hr": 2,
+    "h1": 2, "h2": 2, "h3": 2, "h4": 2, "h5": 2, "h6": 2,
+    "br": 1, "div": 1, "li": 1, "tr": 1,
+}
+SKIP_TAGS = {"script", "style", "head", "title"}
+SAFE_URL_RE = re.compile(r"^(https?|tg|mailto):", re.IGNORECASE)
+WHITESPACE_RE = re.compile(r"\s+")
+TAG_RE = re.compile(r"<[^>]+>")
+ELLIPSIS = "…"
+
+
+def utf16_len(text: str) -> int:
+    # Telegram считает длину в кодовых единицах UTF-16 (эмодзи — это 2)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def visible_length(telegram_html: str) -> int:
+    # Видимая длина уже готового Telegram-HTML (теги и сущности не считаются)
+    return utf16_len(unescape(TAG_RE.sub("", telegram_html)))
+
+
+class TelegramHTMLConverter(HTMLParser):
+    def __init__(self, limit=TELEGRAM_TEXT_LIMIT):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.used = 0             # видимых символов уже выведено
+        self.out = []
+        self.stack = []           # (исходный тег, тег Telegram или None)
+        self.skip = 0
+        self.pending_break = 0
+        self.pending_space = False
+        self.truncated = False
+
+    # ---------- теги ----------
+    def handle_starttag(self, tag, attrs):
+        if self.truncated:
+            return
+        if tag in SKIP_TAGS:
+            self.skip += 1
+            return
+        if tag in BLOCK_BREAKS:
+            self.pending_break = max(self.pending_break, BLOCK_BREAKS[tag])
+            if tag == "li":
+                self._write_text("•")
+                self.pending_space = True
+
+        name = TAG_ALIASES.get(tag)
+        if name is None:
+            return
+        # Пробел перед тегом оставляем снаружи: «слово <b>жирно</b>», а не «слово<b> жирно</b>»
+        if self.pending_space and not self.pending_break and self.used < self.limit:
+            self.out.append(" ")
+            self.used += 1
+            self.pending_space = False
+        open_names = {tg for _, tg in self.stack}
+        if name == "a":
+            href = (dict(attrs).get("href") or "").strip()
+            # Вложенные ссылки и небезопасные схемы оставляем просто текстом
+            if "a" in open_names or not SAFE_URL_RE.match(href):
+                self.stack.append((tag, None))
+                return
+            self.out.append(f'<a href="{escape(href, quote=True)}">')
+        elif name in open_names:
+            self.stack.append((tag, None))
+            return
+        else:
+            self.out.append(f"<{name}>")
+        self.stack.append((tag, name))
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip = max(0, self.skip - 1)
+            return
+        if self.truncated:
+            return
+        if tag in BLOCK_BREAKS:
+            self.pending_break = max(self.pending_break, BLOCK_BREAKS[tag])
+        # Незакрытые внутри теги закрываем вместе с этим
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                while len(self.stack) > i:
+                    _, name = self.stack.pop()
+                    if name:
+                        self.out.append(f"</{name}>")
+                break
+
+    # ---------- текст ----------
+    def handle_data(self, data):
+        if self.skip or self.truncated:
+            return
+        text = WHITESPACE_RE.sub(" ", data).strip()
+        if not text:
+            self.pending_space = self.pending_space or bool(data)
+            return
+        if data[0].isspace():
+            self.pending_space = True
+        self._write_text(text)
+        self.pending_space = data[-1].isspace()
+
+    def _write_text(self, text):
+        if self.used:
+            if self.pending_break:
+                text = "\n" * self.pending_break + text
+            elif self.pending_space:
+                text = " " + text
+        self.pending_break = 0
+        self.pending_space = False
+
+        size = utf16_len(text)
+        if self.used + size <= self.limit:
+            self.out.append(escape(text, quote=False))
+            self.used += size
+            return
+
+        self.truncated = True
+        if self.limit - self.used < utf16_len(ELLIPSIS):
+            return
+        # Не влезает: режем текст до экранирования, чтобы не разрезать сущность
+        self.out.append(escape(truncate_text(text, self.limit - self.used), quote=False))
+        self.used = self.limit
+
+    def result(self):
+        closing = [f"</{name}>" for _, name in reversed(self.stack) if name]
+        return "".join(self.out + closing)
+
+
+def to_telegram_html(raw_html: str, limit: int = TELEGRAM_TEXT_LIMIT) -> str:
+    # HTML из RSS → безопасный Telegram-HTML не длиннее limit видимых символов
+    if limit <= utf16_len(ELLIPSIS):
+        return ""
+    converter = TelegramHTMLConverter(limit)
+    try:
+        converter.feed(raw_html or "")
+        converter.close()
+        return converter.result()
+    except Exception as e:
+        logging.error(f"Ошибка при разборе HTML описания: {e}")
+        text = WHITESPACE_RE.sub(" ", unescape(TAG_RE.sub(" ", raw_html or ""))).strip()
+        return escape(truncate_text(text, limit), quote=False)
+
+
+def truncate_text(text: str, limit: int = TELEGRAM_TEXT_LIMIT) -> str:
+    # Обрезка обычного текста по видимой длине Telegram; суррогатные пары не режутся,
+    # потому что идём по символам Python, а не по кодовым единицам
+    if utf16_len(text) <= limit:
+        return text
+    budget = limit - utf16_len(ELLIPSIS)
+    cut = []
+    for char in text:
+        budget -= utf16_len(char)
+        if budget < 0:
+            break
+        cut.append(char)
+    return "".join(cut).rstrip() + ELLIPSIS
@@ -0,0 +1,43 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.run import install_config
+
+# ——————————————————————————————————————————————————————————
+# Бот читает настройки из config.py, которого нет в репозитории, —
+# подкладываем тестовые до импорта бота (как и нагрузочный стенд).
+# Сеть тестам не нужна: Bot API заменяют заглушки в самих тестах.
+install_config("http://127.0.0.1:9", None)
+
+import CheTamNovosti as bot
+import db
+
+
+@pytest.fixture(scope="session")
+def loop():
+    # Один event loop на все тесты: замки и ведра модулей привязываются к нему
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def run(loop):
+    return loop.run_until_complete
+
+
+@pytest.fixture
+def database(tmp_path, run):
+    # Свежая bot.db во временном каталоге, со всеми таблицами и лентой по умолчанию
+    run(db.connect(str(tmp_path / "bot.db")))
+    run(db.init_db())
+    run(db.seed_feeds(bot.FEEDS_CONFIG))
+    yield db
+    run(bot.cancel_background_tasks())
+    run(db.close())
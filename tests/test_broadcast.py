@@ -0,0 +1,119 @@
+import asyncio
+import types
+
+import pytest
+from conftest import bot
+from telegram.error import Forbidden
+
+SUBSCRIBERS = list(range(1001, 1061))
+
+
+class FakeBot:
+    # Вместо Bot API: запоминает получателей, заблокировавшие бота получают Forbidden
+    def __init__(self, blocked=(), delay=0.0):
+        self.blocked = set(blocked)
+        self.delay = delay
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.delay)
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        self.sent.append(chat_id)
+
+
+@pytest.fixture
+def job_id(run, database, monkeypatch):
+    monkeypatch.setattr(bot, "BROADCAST_RATE", 10_000)
+    monkeypatch.setattr(bot, "BROADCAST_BATCH_SIZE", 10)
+    feed_id = 1
+    run(database.executemany(
+        "INSERT INTO subscriptions (user_id, feed_id, status, created_at) VALUES (?, ?, 'active', 'test')",
+        [(user_id, feed_id) for user_id in SUBSCRIBERS]
+    ))
+    return run(database.create_broadcast_job(feed_id, "Новый выпуск"))
+
+
+def statuses(run, database, job_id):
+    rows = run(database.fetchall(
+        "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE job_id = ? GROUP BY status", (job_id,)
+    ))
+    return dict(rows)
+
+
+def job_status(run, database, job_id):
+    return run(database.fetchone("SELECT status FROM broadcast_jobs WHERE id = ?", (job_id,)))[0]
+
+
+def test_job_delivers_to_everyone_and_finishes(run, database, job_id):
+    fake = FakeBot(blocked=SUBSCRIBERS[:2])
+    stats = run(bot.run_broadcast_job(fake, job_id))
+
+    assert stats == {"sent": 58, "blocked": 2, "failed": 0}
+    assert sorted(fake.sent) == SUBSCRIBERS[2:]
+    assert statuses(run, database, job_id) == {"sent": 58, "blocked": 2}
+    assert job_status(run, database, job_id) == "done"
+    inactive = run(database.fetchall("SELECT user_id FROM subscriptions WHERE status != 'active'"))
+    assert sorted(user_id for (user_id,) in inactive) == SUBSCRIBERS[:2]
+
+
+def test_cancelled_job_checkpoints_batch_and_resumes(run, database, job_id):
+    # Остановка бота посреди рассылки: ничего не остаётся в 'sending',
+    # после возобновления каждый получатель получает сообщение не больше одного раза
+    first = FakeBot(delay=0.02)
+
+    async def stop_midway():
+        task = asyncio.create_task(bot.run_broadcast_job(first, job_id))
+        while len(first.sent) < 25:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    run(stop_midway())
+    after_stop = statuses(run, database, job_id)
+    assert "sending" not in after_stop
+    assert after_stop["sent"] == len(first.sent)
+    assert after_stop.get("pending", 0) > 0
+    assert job_status(run, database, job_id) == "running"
+
+    second = FakeBot()
+
+    async def resume():
+        await bot.resume_broadcast_jobs(types.SimpleNamespace(bot=second))
+        await asyncio.gather(*bot._background_tasks)
+
+    run(resume())
+    final = statuses(run, database, job_id)
+    assert not set(first.sent) & set(second.sent)
+    assert final["sent"] == len(first.sent) + len(second.sent)
+    assert final["sent"] + final.get("unknown", 0) == len(SUBSCRIBERS)
+    assert job_status(run, database, job_id) == "done"
+
+
+def test_failed_job_is_picked_up_again(run, database, job_id, monkeypatch):
+    # Ошибка базы посреди рассылки не должна ждать рестарта процесса
+    checkpoint = database.checkpoint_deliveries
+    calls = []
+
+    async def flaky_checkpoint(job, results):
+        calls.append(job)
+        if len(calls) == 2:
+            raise RuntimeError("database is locked")
+        await checkpoint(job, results)
+
+    monkeypatch.setattr(database, "checkpoint_deliveries", flaky_checkpoint)
+    fake = FakeBot()
+    assert run(bot.run_broadcast_job(fake, job_id)) is None
+    assert job_status(run, database, job_id) == "running"
+
+    async def resume():
+        await bot.resume_broadcast_jobs(types.SimpleNamespace(bot=fake))
+        await asyncio.gather(*bot._background_tasks)
+
+    run(resume())
+    final = statuses(run, database, job_id)
+    assert job_status(run, database, job_id) == "done"
+    # Пачка, статус которой не записался, повторно не шлётся
+    assert final == {"sent": 50, "unknown": 10}
+    assert sorted(fake.sent) == SUBSCRIBERS
@@ -0,0 +1,24 @@
+import pytest
+from conftest import bot
+
+rules = bot.RuleMatcher(["сука", "хуй", "купить"], [r"https?://"])
+
+
+@pytest.mark.parametrize("text", [
+    "ну с у к а же",        # вразбивку одинаковыми пробелами
+    "х.у.й",                # разделители внутри слова
+    "xyй",                  # латиница вместо кириллицы
+    "КУУУПИТЬ дёшево",      # растянутые буквы и регистр
+    "смотри http://spam.example",
+])
+def test_obfuscated_violations_are_found(text):
+    assert rules.search(text)
+
+
+@pytest.mark.parametrize("text", [
+    "А я и ты",
+    "в с е б у д е т хорошо",
+    "привет, как дела?",
+])
+def test_ordinary_text_is_clean(text):
+    assert rules.search(text) is None
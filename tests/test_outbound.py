@@ -0,0 +1,57 @@
+import time
+from datetime import timedelta
+
+import pytest
+from conftest import bot
+from telegram.error import Forbidden, RetryAfter
+
+
+@pytest.fixture
+def limiter(run, monkeypatch):
+    monkeypatch.setattr(bot, "OUTBOUND_JITTER", 0)
+    limiter = bot.OutboundRateLimiter(max_retries=2)
+    run(limiter.initialize())
+    return limiter
+
+
+def flaky(errors):
+    # Колбэк запроса: сначала бросает errors по очереди, потом отвечает True
+    calls = []
+
+    async def callback():
+        calls.append(time.monotonic())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return True
+
+    return callback, calls
+
+
+def test_retry_after_waits_before_retrying_unthrottled_endpoint(run, limiter):
+    # У answerCallbackQuery нет ведра — пауза должна выдерживаться самим повтором
+    callback, calls = flaky([RetryAfter(timedelta(seconds=1))])
+    assert run(limiter.process_request(callback, (), {}, "answerCallbackQuery", {}, None))
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.95
+
+
+def test_retry_after_gives_up_after_max_retries(run, limiter):
+    callback, calls = flaky([RetryAfter(timedelta(0))] * 5)
+    with pytest.raises(RetryAfter):
+        run(limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": 7}, None))
+    assert len(calls) == 3
+
+
+def test_final_errors_are_not_retried(run, limiter):
+    callback, calls = flaky([Forbidden("bot was blocked by the user")])
+    with pytest.raises(Forbidden):
+        run(limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": 7}, None))
+    assert len(calls) == 1
+
+
+def test_edits_skip_the_chat_bucket(run, limiter):
+    callback, calls = flaky([])
+    for _ in range(5):
+        run(limiter.process_request(callback, (), {}, "editMessageText", {"chat_id": 7}, None))
+    assert len(calls) == 5
+    assert 7 not in limiter._chats
@@ -0,0 +1,39 @@
+from telegram_html import (
+    ELLIPSIS,
+    TELEGRAM_TEXT_LIMIT,
+    to_telegram_html,
+    truncate_text,
+    utf16_len,
+    visible_length,
+)
+
+EMOJI = "😀"  # две кодовые единицы UTF-16
+
+
+def test_text_at_the_limit_is_kept():
+    text = "а" * (TELEGRAM_TEXT_LIMIT - 2) + EMOJI
+    assert utf16_len(text) == TELEGRAM_TEXT_LIMIT
+    assert truncate_text(text) == text
+
+
+def test_truncation_counts_utf16_and_keeps_surrogate_pairs():
+    text = "а" * (TELEGRAM_TEXT_LIMIT - 2) + EMOJI * 3
+    cut = truncate_text(text)
+    assert cut.endswith(ELLIPSIS)
+    assert utf16_len(cut) <= TELEGRAM_TEXT_LIMIT
+    # Пара не разрезана: строка кодируется без одиночных суррогатов
+    cut.encode("utf-8")
+    assert cut.rstrip(ELLIPSIS).endswith("а")
+
+
+def test_html_truncation_closes_tags_and_keeps_entities():
+    raw = "<p><b>" + "R&amp;D " * 1100 + EMOJI * 10 + "</b></p>"
+    html = to_telegram_html(raw)
+    assert visible_length(html) <= TELEGRAM_TEXT_LIMIT
+    assert html.startswith("<b>") and html.endswith(ELLIPSIS + "</b>")
+    assert "&amp" not in html.replace("&amp;", "")
+
+
+def test_unsupported_tags_are_escaped():
+    html = to_telegram_html('<script>alert(1)</script><span class="x">1 < 2</span><strong>да</strong>')
+    assert html == "1 &lt; 2<b>да</b>"